@@ -0,0 +1,2 @@
+# the version of setup.py, results cached by the server are not reused across versions
+__version__ = "0.0.1.dev0"
@@ -0,0 +1,190 @@
+# Retipy - Retinal Image Processing on Python
+# Copyright (C) 2018  Alejandro Valdes
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Module to segment many retinal images with Retina_grayscale in a pool of processes. It is installed as the
+retipy-segment command.
+
+Each segmentation is saved as a png mask named after its image, and a line with its timings is appended to a json
+lines manifest as soon as it finishes. When the same output directory is used again, the images already in the
+manifest are skipped, so a run that was stopped resumes where it was.
+"""
+
+import argparse
+import glob
+import json
+import os
+import sys
+import time
+from multiprocessing import Pool
+import numpy as np
+from PIL import Image
+from retipy import retina_grayscale, tiles
+
+IMAGE_EXTENSIONS = [".png", ".jpg", ".jpeg", ".tif", ".tiff", ".bmp", ".ppm", ".pgm"]
+MANIFEST_NAME = "manifest.jsonl"
+
+
+def find_images(paths: list, file_list: str = None):
+    """
+    Lists the images to segment
+    :param paths: a list of image files or directories, directories are searched (not recursively) for files with
+                  one of the IMAGE_EXTENSIONS
+    :param file_list: optional text file with the path of an image in each line
+    :return: a list with the path of each image, without duplicates
+    """
+    images = []
+    for path in paths:
+        if os.path.isdir(path):
+            images.extend(sorted(
+                file for file in glob.glob(os.path.join(path, "*"))
+                if os.path.splitext(file)[1].lower() in IMAGE_EXTENSIONS))
+        else:
+            images.append(path)
+    if file_list is not None:
+        with open(file_list, "r") as list_file:
+            images.extend(line.strip() for line in list_file if line.strip())
+    return list(dict.fromkeys(images))
+
+
+def _image_name(path: str):
+    return os.path.splitext(os.path.basename(path))[0]
+
+
+def read_manifest(path: str):
+    """
+    Reads a manifest written by segment_images. A last line cut by a stopped run is ignored.
+    :param path: the manifest file
+    :return: a dictionary with the entry of each image, by image name. An empty dictionary if the file does not exist
+    """
+    entries = {}
+    if os.path.exists(path):
+        with open(path, "r") as manifest:
+            for line in manifest:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                entries[entry["name"]] = entry
+    return entries
+
+
+def _ends_with_newline(path: str):
+    with open(path, "rb") as manifest:
+        manifest.seek(-1, os.SEEK_END)
+        return manifest.read(1) == b"\n"
+
+
+def _init_worker():
+    # the pool already uses every cpu, tiling each image on top of it would only add contention
+    tiles.threads = 1
+
+
+def _segment(arguments: tuple):
+    image_path, mask_path, fast = arguments
+    entry = {"name": _image_name(image_path), "image": image_path, "mask": mask_path}
+    start = time.perf_counter()
+    try:
+        image = np.array(Image.open(image_path).convert("RGB"))
+        retina = retina_grayscale.Retina_grayscale(image, image_path)
+        segmentation = retina.fast_segmentation() if fast else retina.double_segmentation()
+        # the mask is written under a temporary name first, so a stopped run never leaves a partial mask
+        temporary_path = mask_path + ".tmp"
+        Image.fromarray(segmentation).save(temporary_path, format="PNG")
+        os.replace(temporary_path, mask_path)
+        entry["status"] = "done"
+        entry["timings"] = retina.stage_timings
+    except Exception as error:
+        entry["status"] = "error"
+        entry["error"] = "{}: {}".format(type(error).__name__, error)
+    entry["seconds"] = time.perf_counter() - start
+    return entry
+
+
+def segment_images(images: list, output_directory: str, processes: int = None, fast: bool = False,
+                   manifest_path: str = None, callback=None):
+    """
+    Segments the given images in parallel and saves each mask as <output_directory>/<image name>.png. Images that are
+    already done in the manifest and whose mask exists are skipped, failed images are tried again.
+    :param images: a list with the path of each image, their names (without directory and extension) must be unique
+    :param output_directory: directory for the masks, it is created if needed
+    :param processes: number of worker processes, by default the number of cpus
+    :param fast: if True, the reduced resolution fast_segmentation is used instead of double_segmentation
+    :param manifest_path: the manifest file, by default MANIFEST_NAME in the output directory
+    :param callback: optional function called with the manifest entry of each image when it finishes
+    :return: a dictionary with the manifest entry of each image, by name
+    """
+    names = [_image_name(image) for image in images]
+    duplicated = sorted(set(name for name in names if names.count(name) > 1))
+    if duplicated:
+        raise ValueError("Images with the same name would overwrite their masks: {}".format(", ".join(duplicated)))
+
+    os.makedirs(output_directory, exist_ok=True)
+    if manifest_path is None:
+        manifest_path = os.path.join(output_directory, MANIFEST_NAME)
+    entries = read_manifest(manifest_path)
+
+    pending = []
+    for name, image in zip(names, images):
+        mask_path = os.path.join(output_directory, name + ".png")
+        entry = entries.get(name)
+        if entry is None or entry["status"] != "done" or not os.path.exists(entry["mask"]):
+            pending.append((image, mask_path, fast))
+
+    if pending:
+        with open(manifest_path, "a") as manifest, Pool(processes, _init_worker) as pool:
+            if manifest.tell() > 0 and not _ends_with_newline(manifest_path):
+                manifest.write("\n")
+            for entry in pool.imap_unordered(_segment, pending):
+                manifest.write(json.dumps(entry) + "\n")
+                manifest.flush()
+                entries[entry["name"]] = entry
+                if callback is not None:
+                    callback(entry)
+    return {name: entries[name] for name in names}
+
+
+def main(argv: list = None):
+    """Entry point of the retipy-segment command"""
+    parser = argparse.ArgumentParser(
+        prog="retipy-segment",
+        description="segments retinal images in parallel, a stopped run resumes when it is started again")
+    parser.add_argument("inputs", nargs="*", help="images or directories with images to segment")
+    parser.add_argument("-l", "--file-list", help="text file with the path of an image in each line")
+    parser.add_argument("-o", "--output", required=True, help="directory for the masks and the manifest")
+    parser.add_argument("-p", "--processes", type=int, help="number of worker processes, by default every cpu")
+    parser.add_argument("-m", "--manifest", help="manifest file, by default " + MANIFEST_NAME + " in the output")
+    parser.add_argument("--fast", action="store_true", help="use the reduced resolution fast segmentation")
+    args = parser.parse_args(argv)
+
+    images = find_images(args.inputs, args.file_list)
+    if not images:
+        parser.error("no images to segment")
+
+    def _report(entry: dict):
+        if entry["status"] == "done":
+            print("{}: {:.2f}s".format(entry["image"], entry["seconds"]), flush=True)
+        else:
+            print("{}: {}".format(entry["image"], entry["error"]), flush=True)
+
+    entries = segment_images(images, args.output, args.processes, args.fast, args.manifest, _report)
+    failed = [entry for entry in entries.values() if entry["status"] != "done"]
+    print("{} images segmented, {} failed".format(len(entries) - len(failed), len(failed)))
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":  # pragma: no cover
+    sys.exit(main())
@@ -0,0 +1,175 @@
+# Retipy - Retinal Image Processing on Python
+# Copyright (C) 2018  Alejandro Valdes
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Module to evaluate segmentation and artery/vein classification results against a ground truth.
+Images are compared as whole arrays, A/V images are first encoded as label maps.
+"""
+
+import glob
+import os
+from multiprocessing import Pool
+import cv2
+import numpy as np
+
+BACKGROUND = 0
+VEIN = 1
+ARTERY = 2
+
+# colours used by vessel_classification, in the BGR order used by opencv
+VEIN_COLOR = [255, 0, 0]
+ARTERY_COLOR = [0, 0, 255]
+
+
+def av_labels(image: np.ndarray) -> np.ndarray:
+    """
+    Encodes an A/V coloured image as a label map
+    :param image: a BGR image with veins in VEIN_COLOR and arteries in ARTERY_COLOR
+    :return: an uint8 image with VEIN, ARTERY or BACKGROUND in each pixel
+    """
+    labels = np.full(image.shape[0:2], BACKGROUND, dtype=np.uint8)
+    labels[np.all(image == VEIN_COLOR, axis=2)] = VEIN
+    labels[np.all(image == ARTERY_COLOR, axis=2)] = ARTERY
+    return labels
+
+
+def confusion_matrix(prediction: np.ndarray, ground_truth: np.ndarray, mask: np.ndarray = None,
+                     positive=1, negative=0) -> dict:
+    """
+    Calculates the confusion matrix of a prediction. Only the pixels that are positive or negative in both images are
+    counted.
+    :param prediction: the predicted image (binary mask or label map)
+    :param ground_truth: the expected image, with the same shape as the prediction
+    :param mask: optional boolean image with the pixels to evaluate
+    :param positive: value of the positive class
+    :param negative: value of the negative class
+    :return: a dictionary with the true_positive, true_negative, false_positive and false_negative counts
+    """
+    predicted_positive = prediction == positive
+    predicted_negative = prediction == negative
+    expected_positive = ground_truth == positive
+    expected_negative = ground_truth == negative
+    if mask is not None:
+        mask = mask.astype(bool)
+        predicted_positive &= mask
+        predicted_negative &= mask
+    return {
+        "true_positive": int(np.count_nonzero(predicted_positive & expected_positive)),
+        "true_negative": int(np.count_nonzero(predicted_negative & expected_negative)),
+        "false_positive": int(np.count_nonzero(predicted_positive & expected_negative)),
+        "false_negative": int(np.count_nonzero(predicted_negative & expected_positive))}
+
+
+def _ratio(numerator: int, denominator: int) -> float:
+    return numerator / denominator if denominator else float('nan')
+
+
+def metrics(confusion: dict) -> dict:
+    """
+    Calculates the sensitivity, specificity, accuracy and dice coefficient of the given confusion matrix. Undefined
+    values (divisions by zero) are returned as nan.
+    :param confusion: a dictionary as returned by confusion_matrix
+    :return: the confusion dictionary extended with the metrics
+    """
+    tp = confusion["true_positive"]
+    tn = confusion["true_negative"]
+    fp = confusion["false_positive"]
+    fn = confusion["false_negative"]
+    result = dict(confusion)
+    result["sensitivity"] = _ratio(tp, tp + fn)
+    result["specificity"] = _ratio(tn, tn + fp)
+    result["accuracy"] = _ratio(tp + tn, tp + tn + fp + fn)
+    result["dice"] = _ratio(2 * tp, 2 * tp + fp + fn)
+    return result
+
+
+def evaluate_segmentation(prediction: np.ndarray, ground_truth: np.ndarray, mask: np.ndarray = None) -> dict:
+    """
+    Evaluates a vessel segmentation, vessels are the positive class
+    :param prediction: grayscale segmentation, any value greater than zero is a vessel
+    :param ground_truth: grayscale manual segmentation, any value greater than zero is a vessel
+    :param mask: optional field of view mask, only pixels greater than zero are evaluated
+    :return: a dictionary with the confusion matrix and its metrics
+    """
+    return metrics(confusion_matrix(prediction > 0, ground_truth > 0, None if mask is None else mask > 0, True, False))
+
+
+def evaluate_av(prediction: np.ndarray, ground_truth: np.ndarray, mask: np.ndarray = None) -> dict:
+    """
+    Evaluates an artery/vein classification, arteries are the positive class and veins the negative one
+    :param prediction: a BGR A/V image or its label map
+    :param ground_truth: a BGR A/V image or its label map
+    :param mask: optional boolean image with the pixels to evaluate
+    :return: a dictionary with the confusion matrix and its metrics
+    """
+    if prediction.ndim == 3:
+        prediction = av_labels(prediction)
+    if ground_truth.ndim == 3:
+        ground_truth = av_labels(ground_truth)
+    return metrics(confusion_matrix(prediction, ground_truth, mask, ARTERY, VEIN))
+
+
+def _read(path: str, flags: int) -> np.ndarray:
+    image = cv2.imread(path, flags)
+    if image is None:
+        raise ValueError("Could not read the image '{}'".format(path))
+    return image
+
+
+def _evaluate_files(arguments: tuple) -> dict:
+    prediction_path, ground_truth_path, mask_path, mode = arguments
+    if mode == "av":
+        return evaluate_av(_read(prediction_path, cv2.IMREAD_COLOR), _read(ground_truth_path, cv2.IMREAD_COLOR))
+    mask = None if mask_path is None else _read(mask_path, cv2.IMREAD_GRAYSCALE)
+    return evaluate_segmentation(
+        _read(prediction_path, cv2.IMREAD_GRAYSCALE), _read(ground_truth_path, cv2.IMREAD_GRAYSCALE), mask)
+
+
+def _find_by_name(directory: str, name: str):
+    if directory is None:
+        return None
+    # the name is matched literally, image names can have glob characters like [ or *
+    files = sorted(glob.glob(os.path.join(directory, glob.escape(name) + ".*")))
+    return files[0] if files else None
+
+
+def evaluate_directory(prediction_directory: str, ground_truth_directory: str, mode: str = "segmentation",
+                       mask_directory: str = None, processes: int = None) -> dict:
+    """
+    Evaluates every image of the prediction directory against the ground truth image with the same name (without
+    extension). Images without ground truth are ignored. The evaluation is done in parallel.
+    :param prediction_directory: directory with the predicted images
+    :param ground_truth_directory: directory with the ground truth images
+    :param mode: "segmentation" for vessel segmentations or "av" for artery/vein classifications
+    :param mask_directory: optional directory with field of view masks, only used for segmentations
+    :param processes: number of worker processes, by default the number of cpus
+    :return: a dictionary with the evaluation of each image, by name
+    :raises ValueError: if an image can not be read
+    """
+    if mode not in ["segmentation", "av"]:
+        raise ValueError("Unknown evaluation mode '{}'".format(mode))
+    names = []
+    arguments = []
+    for prediction_path in sorted(glob.glob(os.path.join(prediction_directory, "*"))):
+        name = os.path.splitext(os.path.basename(prediction_path))[0]
+        ground_truth_path = _find_by_name(ground_truth_directory, name)
+        if ground_truth_path is not None:
+            names.append(name)
+            arguments.append((prediction_path, ground_truth_path, _find_by_name(mask_directory, name), mode))
+
+    with Pool(processes) as pool:
+        results = pool.map(_evaluate_files, arguments)
+    return dict(zip(names, results))
@@ -190,17 +190,41 @@ def principal_boxes(skeleton: np.ndarray, landmarks: list, size: int):
     return bifurcations_coordinates, crossings_coordinates
 
 
-def classification(image: np.ndarray, border_size: int):
+def preprocessing(image: np.ndarray, border_size: int):
+    """
+    Thresholds and skeletonizes the given segmented image and finds its potential landmarks. The result can be
+    shared between all the stages that work over the same image to avoid repeating this work.
+    :param image: a segmented image
+    :param border_size: size of the border added to the image before processing it
+    :return: a dictionary with the border size, the thresholded image, the skeleton, the potential landmarks and the
+             skeleton segmented by those landmarks
+    """
     img = retina.Retina(image, None)
     img.reshape_for_landmarks(border_size)
     img.threshold_image()
     threshold = img.get_uint_image()
     img.skeletonization()
     skeleton = img.get_uint_image()
-    img.bin_to_bgr()
-    skeleton_rgb = img.get_uint_image()
-
     landmarks, segmented = potential_landmarks(skeleton, 3)
+    return {
+        "border_size": border_size,
+        "threshold": threshold,
+        "skeleton": skeleton,
+        "landmarks": landmarks,
+        "segmented": segmented}
+
+
+def classification(image: np.ndarray, border_size: int, preprocessed: dict = None):
+    if preprocessed is None:
+        preprocessed = preprocessing(image, border_size)
+    elif preprocessed["border_size"] != border_size:
+        raise ValueError(
+            "Preprocessing was done with a border of {}, expected {}".format(preprocessed["border_size"], border_size))
+    threshold = preprocessed["threshold"]
+    skeleton = preprocessed["skeleton"]
+    skeleton_rgb = np.dstack((skeleton, skeleton, skeleton))
+
+    landmarks = preprocessed["landmarks"]
     widths = vessel_width(threshold, landmarks)
     vessels = finding_landmark_vessels(widths, landmarks, skeleton, skeleton_rgb)
     marked_skeleton, final_landmarks = vessel_number(vessels, landmarks, skeleton_rgb)
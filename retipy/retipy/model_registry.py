@@ -0,0 +1,164 @@
+# Retipy - Retinal Image Processing on Python
+# Copyright (C) 2018  Alejandro Valdes
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Module that keeps the neural network models used by retipy loaded once per process.
+Models are registered by name and loaded lazily the first time they are requested. If the weights file changes on
+disk, the model is loaded again on the next request.
+
+Models can be evaluated with keras or with numpy (see numpy_model), the default backend is taken from the
+RETIPY_INFERENCE_BACKEND environment variable and is keras when it is not set. Keras is only imported when a model
+uses it.
+"""
+
+import os
+import threading
+from retipy import numpy_model
+
+BACKEND_KERAS = "keras"
+BACKEND_NUMPY = "numpy"
+
+default_backend = os.environ.get("RETIPY_INFERENCE_BACKEND", BACKEND_KERAS)
+
+
+class _ModelEntry(object):
+    def __init__(self, json_path: str, weights_path: str, reload: bool, backend: str):
+        self.json_path = json_path
+        self.weights_path = weights_path
+        self.reload = reload
+        self.backend = backend
+        self.model = None
+        self.mtime = None
+
+
+class _SessionModel(object):
+    """Keeps a keras model together with the tensorflow graph and session that it was loaded in"""
+    def __init__(self, model, graph, session):
+        self.model = model
+        self.graph = graph
+        self.session = session
+
+    def predict(self, *args, **kwargs):
+        with self.graph.as_default(), self.session.as_default():
+            return self.model.predict(*args, **kwargs)
+
+
+_models = {}
+_lock = threading.Lock()
+
+
+def _load_keras_model(entry: _ModelEntry):
+    from keras.models import model_from_json
+    with open(entry.json_path, "r") as json_file:
+        model = model_from_json(json_file.read())
+    model.load_weights(entry.weights_path)
+    # keras builds the predict function lazily, build it now so the model can be shared between threads
+    if hasattr(model, "_make_predict_function"):
+        model._make_predict_function()
+    return model
+
+
+def _load(entry: _ModelEntry):
+    if entry.backend == BACKEND_NUMPY:
+        return numpy_model.load(entry.json_path, entry.weights_path)
+    from keras import backend
+    if backend.backend() != "tensorflow":  # pragma: no cover
+        return _load_keras_model(entry)
+    import tensorflow as tf
+    if tf.executing_eagerly():  # pragma: no cover
+        return _load_keras_model(entry)
+    # graph mode tensorflow binds the model to the graph of the thread that loaded it
+    graph = tf.Graph()
+    with graph.as_default():
+        session = tf.Session(graph=graph)
+        with session.as_default():
+            model = _load_keras_model(entry)
+    return _SessionModel(model, graph, session)
+
+
+def register(name: str, json_path: str, weights_path: str, reload: bool = True, backend: str = None):
+    """
+    Registers a model to be loaded the first time it is requested. Registering an existing name replaces it.
+    :param name: the name used to request the model
+    :param json_path: path to the json file with the model architecture
+    :param weights_path: path to the h5 file with the model weights, the numpy backend also accepts a npz file
+    :param reload: if True, the model is loaded again when the weights file modification time changes
+    :param backend: BACKEND_KERAS or BACKEND_NUMPY, None uses default_backend
+    """
+    backend = default_backend if backend is None else backend
+    if backend not in [BACKEND_KERAS, BACKEND_NUMPY]:
+        raise ValueError("Unknown inference backend '{}'".format(backend))
+    with _lock:
+        _models[name] = _ModelEntry(json_path, weights_path, reload, backend)
+
+
+def get(name: str):
+    """
+    Returns the model registered with the given name, loading it if needed. It is safe to call it from several
+    threads, the model will be loaded only once.
+    :param name: the name of a registered model
+    :return: a model with a keras compatible predict method
+    """
+    entry = _models.get(name)
+    if entry is None:
+        raise ValueError("Model '{}' is not registered".format(name))
+    mtime = os.path.getmtime(entry.weights_path) if entry.reload or entry.model is None else entry.mtime
+    model = entry.model
+    if model is None or mtime != entry.mtime:
+        with _lock:
+            if entry.model is None or mtime != entry.mtime:
+                entry.model = _load(entry)
+                entry.mtime = mtime
+            model = entry.model
+    return model
+
+
+def versions():
+    """
+    Returns the version of every registered model, it changes when the weights file or the backend of the model change
+    :return: a dictionary with a [weights path, modification time, backend] list for each model name, the time is None
+             if the weights file does not exist
+    """
+    with _lock:
+        entries = list(_models.items())
+    result = {}
+    for name, entry in entries:
+        try:
+            mtime = os.path.getmtime(entry.weights_path)
+        except OSError:
+            mtime = None
+        result[name] = [entry.weights_path, mtime, entry.backend]
+    return result
+
+
+def preload(names: list = None):
+    """
+    Loads the given models, or all the registered ones, so the first request does not pay for it.
+    :param names: a list with the names of the models to load. None loads every registered model
+    """
+    for name in (names if names is not None else list(_models.keys())):
+        get(name)
+
+
+def unload(name: str = None):
+    """
+    Releases the given model, or all of them. They will be loaded again when requested.
+    :param name: the name of a registered model, None releases every model
+    """
+    with _lock:
+        for entry in ([_models[name]] if name is not None else _models.values()):
+            entry.model = None
+            entry.mtime = None
@@ -0,0 +1,159 @@
+# Retipy - Retinal Image Processing on Python
+# Copyright (C) 2018  Alejandro Valdes
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Module to evaluate keras sequential models of dense layers using only numpy. Models can be read directly from the
+keras json and h5 files, or from a compact npz file created with convert.
+"""
+
+import json
+import h5py
+import numpy as np
+
+
+def _sigmoid(x: np.ndarray):
+    return 1 / (1 + np.exp(-x))
+
+
+def _softmax(x: np.ndarray):
+    e = np.exp(x - x.max(axis=-1, keepdims=True))
+    return e / e.sum(axis=-1, keepdims=True)
+
+
+_activations = {
+    "linear": lambda x: x,
+    "sigmoid": _sigmoid,
+    "relu": lambda x: np.maximum(x, 0),
+    "tanh": np.tanh,
+    "softmax": _softmax,
+}
+
+
+# layers that do not change the (samples, features) input at inference time
+_identity_layers = [
+    "InputLayer", "Dropout", "AlphaDropout", "GaussianDropout", "GaussianNoise", "ActivityRegularization", "Flatten"]
+
+
+def _activation(name: str):
+    if name not in _activations:
+        raise ValueError("Activation '{}' is not supported".format(name))
+    return name
+
+
+class NumpyModel(object):
+    """
+    A sequential model evaluated with numpy.
+
+    :param layers: a list of dictionaries with the type of each layer ("dense" or "activation"), its activation and,
+                   for dense layers, the names of its kernel and bias weights
+    :param weights: a dictionary with the weight arrays
+    """
+    def __init__(self, layers: list, weights: dict):
+        self.layers = layers
+        self.weights = {name: np.asarray(value, dtype=np.float32) for name, value in weights.items()}
+
+    def predict(self, x: np.ndarray, batch_size: int = None):
+        """
+        Evaluates the model for the given input
+        :param x: a (samples, features) array
+        :param batch_size: number of samples evaluated at the same time, None evaluates all of them together
+        :return: a (samples, outputs) array with the model output
+        """
+        x = np.asarray(x, dtype=np.float32)
+        if batch_size is None or batch_size >= x.shape[0]:
+            return self._forward(x)
+        return np.concatenate([self._forward(x[i:i + batch_size]) for i in range(0, x.shape[0], batch_size)])
+
+    def _forward(self, x: np.ndarray):
+        for layer in self.layers:
+            if layer["type"] == "dense":
+                x = np.dot(x, self.weights[layer["kernel"]])
+                if layer["bias"] is not None:
+                    x += self.weights[layer["bias"]]
+            x = _activations[layer["activation"]](x)
+        return x
+
+    def save(self, path: str):
+        """Saves the model as a npz file"""
+        np.savez_compressed(path, architecture=np.array(json.dumps(self.layers)), **self.weights)
+
+    @staticmethod
+    def load(path: str):
+        """Loads a model saved as a npz file"""
+        with np.load(path) as data:
+            layers = json.loads(str(data["architecture"]))
+            weights = {name: data[name] for name in data.files if name != "architecture"}
+        return NumpyModel(layers, weights)
+
+    @staticmethod
+    def from_keras(json_path: str, weights_path: str):
+        """
+        Reads a model saved by keras, without importing keras. Only Dense and Activation layers are supported, besides
+        the layers that do not change a (samples, features) input when predicting, like InputLayer or Dropout.
+        :param json_path: the json file with the model architecture
+        :param weights_path: the h5 file with the model weights
+        """
+        with open(json_path, "r") as json_file:
+            config = json.load(json_file)["config"]
+        if isinstance(config, dict):
+            config = config["layers"]
+
+        layers = []
+        weights = {}
+        with h5py.File(weights_path, "r") as h5f:
+            if "model_weights" in h5f:
+                h5f = h5f["model_weights"]
+            for index, layer in enumerate(config):
+                class_name = layer["class_name"]
+                layer_config = layer["config"]
+                if class_name == "Dense":
+                    group = h5f[layer_config["name"]]
+                    names = [n.decode("utf-8") if isinstance(n, bytes) else n for n in group.attrs["weight_names"]]
+                    kernel = "layer{}_kernel".format(index)
+                    weights[kernel] = group[names[0]][()]
+                    bias = None
+                    if layer_config.get("use_bias", True):
+                        bias = "layer{}_bias".format(index)
+                        weights[bias] = group[names[1]][()]
+                    layers.append({
+                        "type": "dense",
+                        "activation": _activation(layer_config.get("activation", "linear")),
+                        "kernel": kernel,
+                        "bias": bias})
+                elif class_name == "Activation":
+                    layers.append({"type": "activation", "activation": _activation(layer_config["activation"])})
+                elif class_name in _identity_layers:
+                    pass
+                else:
+                    raise ValueError("Layer '{}' is not supported".format(class_name))
+        return NumpyModel(layers, weights)
+
+
+def convert(json_path: str, weights_path: str, output_path: str):
+    """
+    Converts a keras model into a npz file that can be loaded with NumpyModel.load
+    :param json_path: the json file with the model architecture
+    :param weights_path: the h5 file with the model weights
+    :param output_path: the npz file to create
+    """
+    NumpyModel.from_keras(json_path, weights_path).save(output_path)
+
+
+def load(json_path: str, weights_path: str):
+    """Loads a model from a npz file, or from the keras files if the weights path is not a npz file"""
+    if weights_path.endswith(".npz"):
+        return NumpyModel.load(weights_path)
+    return NumpyModel.from_keras(json_path, weights_path)
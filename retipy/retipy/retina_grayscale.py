@@ -17,7 +17,8 @@
 """retina module to handle basic image processing on retinal images"""
 
 import base64
-from copy import copy
+import hashlib
+import time
 import numpy as np
 import cv2
 from scipy import ndimage
@@ -26,6 +27,128 @@ from matplotlib import pyplot as plt
 from os import path
 from PIL import Image
 from io import BytesIO
+from retipy import evaluation
+from retipy import tiles
+
+
+def median_background(image: np.ndarray, kernel: int, scale: int = 1):
+    """
+    Estimates the background of an image with a median filter. With scale 1 the result is the one of cv2.medianBlur,
+    which already uses a constant time (histogram based) algorithm for big kernels. With a greater scale, the median
+    is calculated over the image reduced scale times, with a kernel reduced in the same proportion, and the result is
+    resized back. It is an approximation that is about scale^2 times faster.
+    :param image: an uint8 image
+    :param kernel: the size of the median filter, an odd number
+    :param scale: the reduction factor, the accuracy/speed knob of the estimation
+    :return: an uint8 image with the estimated background
+    """
+    if scale < 1:
+        raise ValueError("The median background scale must be greater or equal than 1")
+    image = image.astype(np.uint8)
+    if scale == 1:
+        return tiles.apply(cv2.medianBlur, image, kernel // 2, kernel)
+    height, width = image.shape[0:2]
+    reduced = cv2.resize(image, (max(1, int(round(width / scale))), max(1, int(round(height / scale)))),
+                         interpolation=cv2.INTER_AREA)
+    reduced_kernel = max(3, int(round(kernel / scale)) // 2 * 2 + 1)
+    return cv2.resize(cv2.medianBlur(reduced, reduced_kernel), (width, height), interpolation=cv2.INTER_LINEAR)
+
+
+def _shadow_correction(image: np.ndarray, mask: np.ndarray, kernel_mean: int, kernel_gaussian: int,
+                       kernel_median: int, median_scale: int = 1):
+    background = tiles.apply(cv2.blur, image, kernel_mean // 2, (kernel_mean, kernel_mean))
+    background = tiles.apply(cv2.GaussianBlur, background, kernel_gaussian // 2, (kernel_gaussian, kernel_gaussian), 1.82)
+    mean_value = np.mean(background)
+    background[mask] = mean_value
+    background = median_background(background, kernel_median, median_scale)
+    # the operations are done in place over a single float image
+    corrected = image.astype(np.float)
+    corrected -= background
+    corrected -= corrected.min()
+    corrected *= float(255) / corrected.max()
+    corrected[mask == 0] = 0
+    # all the values are between 0 and 255, converting them to uint8 truncates them as int did
+    return corrected.astype(np.uint8), mean_value
+
+
+def _homogenize(image: np.ndarray):
+    shift = 180 - int(image.max())
+    return np.clip(image.astype(np.int16) + shift, 0, 255).astype(np.uint8)
+
+
+def _refine_borders(image: np.ndarray, segmentation: np.ndarray, factor: float):
+    """
+    Refines a segmentation resized from a lower resolution. Only the pixels in a band of the size of one reduced
+    pixel around the vessel borders are changed, each one is assigned to the vessels or to the background depending
+    on which local mean intensity (of the vessel or of the background pixels around it) is closer to its own.
+    :param image: the full resolution grayscale image
+    :param segmentation: the resized boolean segmentation
+    :param factor: the ratio between the full and the reduced resolution
+    :return: the refined boolean segmentation
+    """
+    band_size = int(round(factor)) | 1
+    structure = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (band_size, band_size))
+    vessels = segmentation.astype(np.uint8)
+    band = cv2.dilate(vessels, structure) != cv2.erode(vessels, structure)
+
+    kernel = (int(round(4 * factor)) | 1,) * 2
+    image = image.astype(np.float32)
+    vessels = vessels.astype(np.float32)
+    background = 1 - vessels
+    vessels_mean = cv2.blur(image * vessels, kernel) / np.maximum(cv2.blur(vessels, kernel), 1e-6)
+    background_mean = cv2.blur(image * background, kernel) / np.maximum(cv2.blur(background, kernel), 1e-6)
+
+    refined = segmentation.copy()
+    refined[band] = (np.abs(image - vessels_mean) < np.abs(image - background_mean))[band]
+    return refined
+
+
+def _small_components(binary: np.ndarray, max_area: int = None, max_radius: float = None, holes: bool = False):
+    """
+    Finds the connected components of a binary image that are smaller than the given contour area or radius, in one
+    pass of cv2.connectedComponentsWithStats. It replaces the loops over the contours of cv2.findContours (RETR_TREE)
+    that measured each contour and filled it with cv2.drawContours. The measures are estimated from the component
+    statistics, so they are not always the same:
+    - the contour area is estimated from the number of pixels n and the number of pixel sides e on the border of the
+      component, as n - e / 2 + 1 for objects and n + e / 2 - 1 for holes (whose contour goes through the pixels
+      around them). It is exact for rectangles and lines, cv2.contourArea can differ for irregular shapes.
+    - the radius is half the diagonal of the bounding box of the contour, an upper bound of the radius of the
+      minimum enclosing circle.
+    - filling a hole contour with the background colour also erased the ring of pixels of the contour, removing the
+      selected components does not.
+    :param binary: the image, any value greater than zero belongs to a component
+    :param max_area: components with a smaller contour area than this are selected
+    :param max_radius: components with a smaller radius than this are selected
+    :param holes: if True, the components are holes (4-connected, not touching the image border), otherwise they are
+                  objects (8-connected), as in cv2.findContours
+    :return: a boolean image with the pixels of the selected components
+    """
+    binary = binary > 0
+    count, labels, stats, _ = cv2.connectedComponentsWithStats(binary.astype(np.uint8), connectivity=4 if holes else 8)
+    x = stats[:, cv2.CC_STAT_LEFT]
+    y = stats[:, cv2.CC_STAT_TOP]
+    width = stats[:, cv2.CC_STAT_WIDTH]
+    height = stats[:, cv2.CC_STAT_HEIGHT]
+    sign = 1 if holes else -1
+    selected = np.ones(count, dtype=bool)
+    if max_area is not None:
+        padded = np.pad(binary, 1, 'constant')
+        sides = np.zeros(count)
+        for neighbour in [padded[:-2, 1:-1], padded[2:, 1:-1], padded[1:-1, :-2], padded[1:-1, 2:]]:
+            sides += np.bincount(labels[binary & ~neighbour], minlength=count)
+        selected &= stats[:, cv2.CC_STAT_AREA] + sign * (sides / 2 - 1) < max_area
+    if max_radius is not None:
+        selected &= np.hypot(width + sign, height + sign) / 2 < max_radius
+    if holes:
+        selected &= (x > 0) & (y > 0) & (x + width < binary.shape[1]) & (y + height < binary.shape[0])
+    # label 0 are the pixels that are not part of any component
+    selected[0] = False
+    return selected[labels]
+
+
+def _fingerprint(image: np.ndarray):
+    return image.shape, image.dtype.str, hashlib.sha1(np.ascontiguousarray(image)).hexdigest()
+
 
 class Retina_grayscale(object):
     """
@@ -35,7 +158,23 @@ class Retina_grayscale(object):
     :param image: a numpy array with the image data
     :param image_path: path to an image to be open
     :param image_type: This value represent the image resolution. When this value is zero, the algorithm is set automatically
+    :param median_scale: reduction used to estimate the background with the median filter, 1 is exact and greater
+                         values are faster approximations (see median_background)
     """
+    # attributes that change the result of each segmentation stage, arrays are compared by their fingerprint
+    _stage_parameters = {
+        "normal_background": ["kernel_mean_filter", "kernel_gaussian_filter", "kernel_median_filter", "median_scale",
+                              "mask"],
+        "normal_vessels": ["normal_vessels_segmentation_min_value"],
+        "tiny_preprocessing": ["kernel_opening", "mask"],
+        "tiny_background": ["kernel_mean_filter", "kernel_gaussian_filter", "kernel_median_filter", "median_scale",
+                            "mask"],
+        "tiny_vessels": ["main_adaptative_method", "tiny_vessels_threshold", "kernel_erode",
+                         "tiny_vessels_segmentation_min_value", "kernel_dilate"],
+        "combine": [],
+        "post_processing": ["kernel_dilate", "postprocesing_segmentation_min_value", "maximum_radius_to_fill",
+                            "smoothing_curves_iterations", "smoothing_curves_kernel", "kernel_erode"]}
+
     @staticmethod
     def _open_image(img_path):
         return io.imread(img_path)
@@ -47,7 +186,7 @@ class Retina_grayscale(object):
         temp_image.save(buffer, format="png")
         return str(base64.b64encode(buffer.getvalue()).decode('utf-8'))
 
-    def __init__(self, image: np.ndarray, image_path: str, image_type: int=0):
+    def __init__(self, image: np.ndarray, image_path: str, image_type: int=0, median_scale: int=1):
         if image is None:
             self.np_image = self._open_image(image_path)
             _, file = path.split(image_path)
@@ -56,14 +195,15 @@ class Retina_grayscale(object):
             self.np_image = image
             self._file_name = image_path
 
-        self.np_image = self.np_image[:, :, 1]
+        # a copy of the green channel, so the colour image is not kept alive by a view
+        self.np_image = np.ascontiguousarray(self.np_image[:, :, 1])
         """if(self.np_image.shape[0] == 3328):
             self.np_image[3270:3328, :] = 0"""
         self.old_image = None
+        self.IH = None
         self.shape = self.np_image.shape
         self.original_image = self.np_image
         self.segmented = False
-        self.segmented_image = np.zeros((self.shape))
         self.roc = np.zeros((1,5)).astype(np.float)
 
         if image_type == 0:
@@ -105,7 +245,10 @@ class Retina_grayscale(object):
             self.smoothing_curves_iterations = 2
             self.smoothing_curves_kernel = 3
 
-        self.mask = abs(1 - self.mask)
+        self.mask = (~self.mask).astype(np.uint8)
+        self.median_scale = median_scale
+        self._stages = {}
+        self.stage_timings = {}
 
 ##################################################################################################
 # Image Processing functions
@@ -128,7 +271,8 @@ class Retina_grayscale(object):
         :param size_structure: size of kernel to apply in the filter
         """
         self._copy()
-        self.np_image = ndimage.grey_opening(self.np_image, size=(size_structure, size_structure))
+        self.np_image = tiles.apply(ndimage.grey_opening, self.np_image, tiles.opening_halo(size_structure),
+                                    size=(size_structure, size_structure))
 
     def closing(self, size_structure):
         """
@@ -136,7 +280,8 @@ class Retina_grayscale(object):
         :param size_structure: size of kernel to apply in the filter
         """
         self._copy()
-        self.np_image = ndimage.grey_closing(self.np_image, size=(size_structure, size_structure))
+        self.np_image = tiles.apply(ndimage.grey_closing, self.np_image, tiles.opening_halo(size_structure),
+                                    size=(size_structure, size_structure))
 
     def top_hat(self, size_structuring_element):
         """
@@ -144,7 +289,7 @@ class Retina_grayscale(object):
         :param size_structure: size of kernel to apply in the filter
         """
         self._copy()
-        self.np_image = cv2.morphologyEx(self.np_image, cv2.MORPH_TOPHAT, cv2.getStructuringElement(cv2.MORPH_RECT, (size_structuring_element, size_structuring_element)))
+        self.np_image = tiles.apply(cv2.morphologyEx, self.np_image, tiles.opening_halo(size_structuring_element), cv2.MORPH_TOPHAT, cv2.getStructuringElement(cv2.MORPH_RECT, (size_structuring_element, size_structuring_element)))
 
     def mean_filter(self, structure):
         """
@@ -152,7 +297,7 @@ class Retina_grayscale(object):
         :param size_structure: size of kernel to apply in the filter
         """
         self._copy()
-        self.np_image = cv2.blur(self.np_image,(structure,structure))#signal.medfilt(self.np_image, structure)
+        self.np_image = tiles.apply(cv2.blur, self.np_image, structure // 2, (structure,structure))#signal.medfilt(self.np_image, structure)
 
     def gaussian_filter(self, structure, sigma):
         """
@@ -160,7 +305,7 @@ class Retina_grayscale(object):
         :param size_structure: size of kernel to apply in the filter
         """
         self._copy()
-        self.np_image = cv2.GaussianBlur(self.np_image, (structure, structure), sigma)
+        self.np_image = tiles.apply(cv2.GaussianBlur, self.np_image, structure // 2, (structure, structure), sigma)
 
     def median_filter(self, structure):
         """
@@ -168,7 +313,7 @@ class Retina_grayscale(object):
         :param size_structure: size of kernel to apply in the filter
         """
         self._copy()
-        self.np_image = cv2.medianBlur(self.np_image.astype(np.uint8), structure)#ndimage.median_filter(self.np_image, size=(structure, structure))
+        self.np_image = tiles.apply(cv2.medianBlur, self.np_image.astype(np.uint8), structure // 2, structure)#ndimage.median_filter(self.np_image, size=(structure, structure))
 
     def shadow_correction(self):
         """Applies the following filters: mean filter with a 3x3 kernel, Gaussian filter with a kernel of 9x9
@@ -176,97 +321,110 @@ class Retina_grayscale(object):
         original image and finally the values obtained from the subtraction are moved to the 256 possible grayscale values"""
 
         self._copy()
-        minuendo = np.copy(self.np_image)
-        self.mean_filter(self.kernel_mean_filter)
-        self.gaussian_filter(self.kernel_gaussian_filter, 1.82)
-        self.mean_value = np.mean(self.np_image)
-        self.np_image[self.mask] = self.mean_value
-        self.median_filter(self.kernel_median_filter)#Ver si es posible aumentarlo en otro pc
-        self.np_image = minuendo - self.np_image.astype(np.float)
-        min = self.np_image.min()
-        self.np_image = self.np_image - min
-        max = self.np_image.max()
-        escala = float(255) / (max)
-        for row in range(0, self.shape[0]):
-            for col in range(0, self.shape[1]):
-                self.np_image[row, col] = int(self.np_image[row, col] * escala)
-        self.restore_mask()
+        self.np_image, self.mean_value = _shadow_correction(
+            self.np_image, self.mask, self.kernel_mean_filter, self.kernel_gaussian_filter, self.kernel_median_filter,
+            self.median_scale)
 
     def homogenize(self):
         """Moves all the values resulting from the correction of the shadows to the possible 255 values"""
         self._copy()
-        g_input_max = self.np_image.max()
-        aux = np.zeros(self.shape)
-        for row in range(0, self.shape[0]):
-            for col in range(0, self.shape[1]):
-                g = self.np_image[row, col] + 180 - g_input_max
-                if (g < 0):
-                    aux[row, col] = 0
-                elif (g > 255): # pragma: no cover
-                    aux[row, col] = 255
-                else:
-                    aux[row, col] = g
-        self.np_image = aux
-        self.IH = np.copy(aux)
+        self.np_image = _homogenize(self.np_image)
+        self.IH = self.np_image
 
-    def normal_vessels_segmentation(self):
-        self.shadow_correction()
-        self.homogenize()
-        IH = cv2.GaussianBlur(self.IH, (3, 3), 1.72).astype(np.uint8)
+    def _stage(self, name: str, function, *inputs):
+        """
+        Runs a stage of the segmentation. The result is stored and returned again, without running the stage, while
+        its inputs and its parameters (see _stage_parameters) do not change. An input that is the stored result of
+        another stage is identified by that stage instead of by its data. The time of the stage is kept in
+        stage_timings.
+        :param name: the name of the stage
+        :param function: the function that runs the stage, it must not modify its inputs
+        :param inputs: the images given to the function
+        :return: the result of the stage, it must not be modified
+        """
+        start = time.perf_counter()
+        key = [tuple(_fingerprint(value) if isinstance(value, np.ndarray) else value
+                     for value in (getattr(self, parameter) for parameter in self._stage_parameters[name]))]
+        for image in inputs:
+            stage = next((n for n, (k, r) in self._stages.items() if r is image), None)
+            key.append((stage, self._stages[stage][0]) if stage is not None else _fingerprint(image))
+        stored = self._stages.get(name)
+        if stored is None or stored[0] != key:
+            stored = (key, function(*inputs))
+            self._stages[name] = stored
+        self.stage_timings[name] = time.perf_counter() - start
+        return stored[1]
+
+    def _background(self, image: np.ndarray):
+        corrected, _ = _shadow_correction(
+            image, self.mask, self.kernel_mean_filter, self.kernel_gaussian_filter, self.kernel_median_filter,
+            self.median_scale)
+        return _homogenize(corrected)
+
+    def _normal_vessels(self, IH: np.ndarray):
+        IH = cv2.GaussianBlur(IH.astype(np.float), (3, 3), 1.72).astype(np.uint8)
         ret, normal_vessels_segmentation = cv2.threshold(IH, 0, 255, cv2.THRESH_OTSU)
-        npaContours, hierarchy = cv2.findContours(normal_vessels_segmentation, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
-        for npaContour in npaContours:
-            if (cv2.contourArea(npaContour) < self.normal_vessels_segmentation_min_value):  # 100
-                cv2.drawContours(normal_vessels_segmentation, [npaContour], -1, (255, 255, 255), -1)
+        # fills the small holes, the vessels are the holes of the thresholded image
+        normal_vessels_segmentation[_small_components(
+            255 - normal_vessels_segmentation, max_area=self.normal_vessels_segmentation_min_value, holes=True)] = 255
         return abs(255 - normal_vessels_segmentation)
 
+    def _tiny_preprocessing(self, image: np.ndarray):
+        # the CLAHE histograms are calculated over a grid of the whole image, so it can not be split in tiles
+        clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(3, 3))
+        equalized = clahe.apply(image)
+        equalized[self.mask == 0] = 0
+        return tiles.apply(ndimage.grey_opening, equalized, tiles.opening_halo(self.kernel_opening),
+                           size=(self.kernel_opening, self.kernel_opening))
 
-    def tiny_vessels_segmentation(self):
-        self.equalize_histogram()
-        self.opening(self.kernel_opening)
-        self.shadow_correction()
-        self.homogenize()
-        IH = cv2.GaussianBlur(self.IH, (3, 3), 1.72).astype(np.uint8)
+    def _tiny_vessels(self, IH: np.ndarray):
+        IH = cv2.GaussianBlur(IH.astype(np.float), (3, 3), 1.72).astype(np.uint8)
 
-        tiny_vessels_segmentation = cv2.adaptiveThreshold(IH, 255, self.main_adaptative_method, cv2.THRESH_BINARY, self.tiny_vessels_threshold, 2)#13
+        tiny_vessels_segmentation = tiles.apply(cv2.adaptiveThreshold, IH, self.tiny_vessels_threshold // 2, 255, self.main_adaptative_method, cv2.THRESH_BINARY, self.tiny_vessels_threshold, 2)#13
 
         tiny_vessels_segmentation = abs(255 - tiny_vessels_segmentation)
 
         kernel = np.ones((self.kernel_erode, self.kernel_erode), np.uint8)
         tiny_vessels_segmentation = cv2.erode(tiny_vessels_segmentation, kernel, iterations=1)
 
-        npaContours, hierarchy = cv2.findContours(tiny_vessels_segmentation, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
-        for npaContour in npaContours:
-            if (cv2.contourArea(npaContour) < self.tiny_vessels_segmentation_min_value):  # pragma: no cover
-                cv2.drawContours(tiny_vessels_segmentation, [npaContour], -1, (0, 0, 0), -1) # 250
+        # removes the small objects
+        tiny_vessels_segmentation[_small_components(
+            tiny_vessels_segmentation, max_area=self.tiny_vessels_segmentation_min_value)] = 0
 
         kernel = np.ones((self.kernel_dilate, self.kernel_dilate), np.uint8)
         tiny_vessels_segmentation = cv2.dilate(tiny_vessels_segmentation, kernel, iterations=1)
         return tiny_vessels_segmentation
 
+    @staticmethod
+    def _combine(normal_vessels_segmentation: np.ndarray, tiny_vessels_segmentation: np.ndarray):
+        final_vessels_segmentation = (normal_vessels_segmentation > 0) | (tiny_vessels_segmentation > 0)
+        return final_vessels_segmentation.astype(np.uint8) * 255
+
+    def normal_vessels_segmentation(self):
+        IH = self._stage("normal_background", self._background, self.np_image)
+        self.np_image = self.IH = np.copy(IH)
+        return np.copy(self._stage("normal_vessels", self._normal_vessels, IH))
+
+    def tiny_vessels_segmentation(self):
+        preprocessed = self._stage("tiny_preprocessing", self._tiny_preprocessing, self.np_image)
+        IH = self._stage("tiny_background", self._background, preprocessed)
+        self.np_image = self.IH = np.copy(IH)
+        return np.copy(self._stage("tiny_vessels", self._tiny_vessels, IH))
+
     def post_processing(self, final_vessels_segmentation):
         kernel = np.ones((self.kernel_dilate, self.kernel_dilate), np.uint8)
         final_vessels_segmentation = cv2.dilate(final_vessels_segmentation, kernel, iterations=1)
         final_vessels_segmentation = abs(255 - final_vessels_segmentation)
 
-        npaContours, hierarchy = cv2.findContours(final_vessels_segmentation.astype(np.uint8), cv2.RETR_TREE,
-                                                     cv2.CHAIN_APPROX_SIMPLE)
-        for npaContour in npaContours:
-            (x, y), radius = cv2.minEnclosingCircle(npaContour)
-            if (radius < self.postprocesing_segmentation_min_value):
-                center = (int(x), int(y))
-                cv2.drawContours(final_vessels_segmentation, [npaContour], -1, (255, 255, 255), -1)
+        # removes the small vessel pieces, they are the holes of the inverted image
+        final_vessels_segmentation[_small_components(
+            255 - final_vessels_segmentation, max_radius=self.postprocesing_segmentation_min_value, holes=True)] = 255
 
         final_vessels_segmentation = abs(255 - final_vessels_segmentation)
 
-        npaContours, hierarchy = cv2.findContours(final_vessels_segmentation.astype(np.uint8), cv2.RETR_TREE,
-                                                     cv2.CHAIN_APPROX_SIMPLE)
-        for npaContour in npaContours:
-            (x, y), radius = cv2.minEnclosingCircle(npaContour)
-            if (radius < self.maximum_radius_to_fill):
-                center = (int(x), int(y))
-                # cv2.circle(final_vessels_segmentation, center, int(radius), (0, 0, 0), 2)
-                cv2.drawContours(final_vessels_segmentation, [npaContour], -1, (255, 255, 255), -1)
+        # fills the small holes of the vessels
+        final_vessels_segmentation[_small_components(
+            255 - final_vessels_segmentation, max_radius=self.maximum_radius_to_fill, holes=True)] = 255
         cv2.pyrUp(final_vessels_segmentation, final_vessels_segmentation)
         for i in range(0, self.smoothing_curves_iterations):
             final_vessels_segmentation = cv2.medianBlur(final_vessels_segmentation.astype(np.uint8), self.smoothing_curves_kernel)
@@ -277,44 +435,93 @@ class Retina_grayscale(object):
         final_vessels_segmentation = cv2.erode(final_vessels_segmentation, kernel, iterations=1)
         return final_vessels_segmentation
 
+    def _double_segmentation(self):
+        self.stage_timings = {}
+        start = time.perf_counter()
+        normal_background = self._stage("normal_background", self._background, self.original_image)
+        normal_vessels_segmentation = self._stage("normal_vessels", self._normal_vessels, normal_background)
+        preprocessed = self._stage("tiny_preprocessing", self._tiny_preprocessing, self.original_image)
+        tiny_background = self._stage("tiny_background", self._background, preprocessed)
+        tiny_vessels_segmentation = self._stage("tiny_vessels", self._tiny_vessels, tiny_background)
+        final_vessels_segmentation = self._stage(
+            "combine", self._combine, normal_vessels_segmentation, tiny_vessels_segmentation)
+        final_vessels_segmentation = self._stage("post_processing", self.post_processing, final_vessels_segmentation)
+
+        self.np_image = self.IH = np.copy(tiny_background)
+        self.stage_timings["total"] = time.perf_counter() - start
+        return final_vessels_segmentation
+
     def double_segmentation(self):
-        normal_vessels_segmentation = self.normal_vessels_segmentation()
-        self.np_image = self.original_image
-        tiny_vessels_segmentation = self.tiny_vessels_segmentation()
-        final_vessels_segmentation = tiny_vessels_segmentation.astype(np.float) + normal_vessels_segmentation.astype(np.float)
-        k = final_vessels_segmentation >= 1
-        final_vessels_segmentation[k] = 255
-        k2 = final_vessels_segmentation <= 0
-        final_vessels_segmentation[k2] = 0
-
-        final_vessels_segmentation = self.post_processing(final_vessels_segmentation)
-        return self.get_base64_image(final_vessels_segmentation)
+        """
+        Segments the vessels combining the normal and tiny vessels segmentations. The segmentation runs in stages,
+        a stage whose inputs did not change since a previous run reuses its result. The time of each stage is kept
+        in stage_timings. The result can be encoded as a png with get_base64_image.
+        :return: an uint8 image with the vessels in 255 and the background in 0
+        """
+        return np.copy(self._double_segmentation())
+
+    def fast_segmentation(self, working_size: int = 1020):
+        """
+        Segments the vessels at a reduced working resolution with the parameters of the low resolution images
+        (image_type 2). The reduced segmentation is resized back and refined along the vessel borders with the full
+        resolution image. Images that already fit in the working resolution are segmented with double_segmentation.
+        The time of the reduced segmentation and of the refinement is kept in stage_timings.
+        :param working_size: maximum number of rows and columns of the working resolution
+        :return: an uint8 image with the vessels in 255 and the background in 0
+        """
+        factor = max(self.shape) / working_size
+        if factor <= 1:
+            return self.double_segmentation()
+
+        self.stage_timings = {}
+        start = time.perf_counter()
+        reduced_shape = (max(1, int(round(self.shape[1] / factor))), max(1, int(round(self.shape[0] / factor))))
+        reduced_image = cv2.resize(self.original_image, reduced_shape, interpolation=cv2.INTER_AREA)
+        with Retina_grayscale(np.dstack((reduced_image,) * 3), self._file_name, 2, self.median_scale) as reduced:
+            segmentation = np.copy(reduced._double_segmentation())
+        self.stage_timings["reduced_segmentation"] = time.perf_counter() - start
+
+        refinement_start = time.perf_counter()
+        segmentation = cv2.resize(segmentation.astype(np.uint8), (self.shape[1], self.shape[0]),
+                                  interpolation=cv2.INTER_LINEAR) > 127
+        segmentation = _refine_borders(self.original_image, segmentation, factor)
+        self.stage_timings["refinement"] = time.perf_counter() - refinement_start
+        self.stage_timings["total"] = time.perf_counter() - start
+        return segmentation.astype(np.uint8) * 255
 
     def calculate_roc(self, image, result):
-        true_positive = 0
-        true_negative = 0
-        false_positive = 0
-        false_negative = 0
-        for i in range(0, result.shape[0]):
-            for j in range(0, result.shape[1]):
-                if (self.mask[i, j] == 1):
-                    if (image[i, j] == 1 and result[i, j] == 1):
-                        true_positive += 1
-                    elif (image[i, j] == 0 and result[i, j] == 0):
-                        true_negative += 1
-                    elif (image[i, j] == 1 and result[i, j] == 0):
-                        false_positive += 1
-                    elif (image[i, j] == 0 and result[i, j] == 1):
-                        false_negative += 1
-        print(true_positive, true_negative, false_positive, false_negative)
-        self.roc[0, :] = [true_positive, true_negative, false_positive, false_negative,
-                          (true_positive + true_negative + false_positive + false_negative)]
+        """
+        Stores in roc the true positives, true negatives, false positives, false negatives and the number of
+        evaluated pixels of the given segmentation, evaluated inside the mask
+        :param image: the binary segmentation to evaluate
+        :param result: the binary expected segmentation
+        """
+        confusion = evaluation.confusion_matrix(image, result, self.mask == 1)
+        self.roc[0, :] = [confusion["true_positive"], confusion["true_negative"], confusion["false_positive"],
+                          confusion["false_negative"], sum(confusion.values())]
 
     ##################################################################################################
 # I/O functions
 
     def _copy(self):
-        self.old_image = copy(self.np_image)
+        # the filters replace np_image instead of modifying it, so the previous image does not need to be copied
+        self.old_image = self.np_image
+
+    def release(self):
+        """
+        Frees the intermediate images: the stored results of the segmentation stages, the previous image and the
+        homogenized image. The image, its mask and the parameters are kept, so the instance can still be used, but
+        the next segmentation runs every stage again. It is called when the instance is used as a context manager.
+        """
+        self._stages = {}
+        self.old_image = None
+        self.IH = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
 
     def view(self):  # pragma: no cover
         """show a window with the internal image"""
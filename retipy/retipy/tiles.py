@@ -0,0 +1,84 @@
+# Retipy - Retinal Image Processing on Python
+# Copyright (C) 2018  Alejandro Valdes
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Module to run local image filters over horizontal tiles of an image in a pool of threads. The OpenCV and
+scipy.ndimage filters used by retipy (like medianBlur, GaussianBlur or grey_opening) release the GIL while filtering,
+so the tiles are filtered in parallel. Each tile is extended with a halo of rows from its
+neighbours that covers the filter kernel, so the stitched result is identical to filtering the whole image.
+
+The number of threads is taken from the RETIPY_THREADS environment variable, by default every cpu is used.
+"""
+
+import os
+import threading
+from multiprocessing.pool import ThreadPool
+import numpy as np
+
+threads = int(os.environ.get("RETIPY_THREADS", os.cpu_count() or 1))
+
+# images are not split in tiles with less rows than this
+min_tile_rows = 256
+
+_pool = None
+_pool_threads = None
+_pool_pid = None
+_lock = threading.Lock()
+
+
+def _get_pool():
+    global _pool, _pool_threads, _pool_pid
+    with _lock:
+        # a forked process does not have the threads of its parent pool, it needs a pool of its own
+        if _pool is None or _pool_threads != threads or _pool_pid != os.getpid():
+            if _pool is not None and _pool_pid == os.getpid():
+                _pool.close()
+            _pool = ThreadPool(threads)
+            _pool_threads = threads
+            _pool_pid = os.getpid()
+        return _pool
+
+
+def apply(function, image: np.ndarray, halo: int, *args, **kwargs):
+    """
+    Applies a local filter over horizontal tiles of the image and stitches the results. The filter must give to each
+    pixel a value that only depends on the pixels up to halo rows away from it.
+    :param function: the filter, it is called as function(tile, *args, **kwargs) and must return an image with the
+                     rows of the tile
+    :param image: the image to filter
+    :param halo: number of rows that the filter reads at each side of a pixel, usually the kernel radius
+    :return: the filtered image
+    """
+    rows = image.shape[0]
+    tiles = min(threads, rows // max(min_tile_rows, 1))
+    if tiles <= 1:
+        return function(image, *args, **kwargs)
+
+    bounds = np.linspace(0, rows, tiles + 1).astype(int)
+
+    def _filter_tile(tile: int):
+        start = bounds[tile]
+        end = bounds[tile + 1]
+        top = max(0, start - halo)
+        bottom = min(rows, end + halo)
+        return function(image[top:bottom], *args, **kwargs)[start - top:end - top]
+
+    return np.concatenate(_get_pool().map(_filter_tile, range(tiles)))
+
+
+def opening_halo(size: int):
+    """Returns the halo of a morphological opening or closing, an erosion and a dilation of the given size"""
+    return 2 * (size // 2)
@@ -3,64 +3,92 @@ import cv2
 import h5py
 import glob
 import os
-from keras.models import model_from_json
+from multiprocessing import Pool
+from retipy import evaluation
 from retipy import retina
 from retipy import landmarks as l
+from retipy import model_registry
 
 """Module with operations related to classify vessels into arteries and veins."""
 
 _base_directory_training = 'retipy/resources/images/drive/training/'
 _base_directory_test = 'retipy/resources/images/drive/test/'
 _base_directory_model = os.path.join(os.path.dirname(__file__), 'model/')
+_model_name = 'modelVA'
+_predict_batch_size = 4096
+
+# classes of the A/V label maps, background, veins and arteries use the values of the evaluation module
+SKELETON = 3
+
+_palette = np.zeros((256, 3), dtype=np.uint8)
+_palette[evaluation.VEIN] = evaluation.VEIN_COLOR
+_palette[evaluation.ARTERY] = evaluation.ARTERY_COLOR
+_palette[SKELETON] = [255, 255, 255]
+
+
+def _register_model():
+    # RETIPY_VA_MODEL can give a npz file created with numpy_model.convert, it is then evaluated with numpy
+    npz_path = os.environ.get("RETIPY_VA_MODEL")
+    if npz_path:
+        model_registry.register(
+            _model_name, _base_directory_model + 'modelVA.json', npz_path, backend=model_registry.BACKEND_NUMPY)
+    else:
+        model_registry.register(
+            _model_name, _base_directory_model + 'modelVA.json', _base_directory_model + 'modelVA.h5')
+
+
+_register_model()
 
 
 def _vessel_widths(center_img: np.ndarray, segmented_img: np.ndarray):
     image = segmented_img.copy()
     widths = []
-    for i in range(0, image.shape[0]):
-        for j in range(0, image.shape[1]):
-            if center_img[i, j] == 255:
-                w0 = 0
-                w45 = 0
-                w90 = 0
-                w135 = 0
-                w180 = 1
-                w225 = 1
-                w270 = 1
-                w315 = 1
-                while True:
-                    if image[i, j + w0 + 1] != 0:
-                        w0 += 1
-                    if image[i, j - w180 - 1] != 0:
-                        w180 += 1
-                    if image[i - w90 - 1, j] != 0:
-                        w90 += 1
-                    if image[i + w270 + 1, j] != 0:
-                        w270 += 1
-                    if image[i - w45 - 1, j + w45 + 1] != 0:
-                        w45 += 1
-                    if image[i + w225 + 1, j - w225 - 1] != 0:
-                        w225 += 1
-                    if image[i - w135 - 1, j - w135 - 1] != 0:
-                        w135 += 1
-                    if image[i + w315 + 1, j + w315 + 1] != 0:
-                        w315 += 1
-
-                    if image[i, j + w0 + 1] == 0 and image[i, j - w180 - 1] == 0:
-                        widths.append([i, j, 0, w0, w180])
-                        break
-                    elif image[i - w90 - 1, j] == 0 and image[i + w270 + 1, j] == 0:
-                        widths.append([i, j, 90, w90, w270])
-                        break
-                    elif image[i - w45 - 1, j + w45 + 1] == 0 and image[i + w225 + 1, j - w225 - 1] == 0:
-                        widths.append([i, j, 45, w45, w225])
-                        break
-                    elif image[i - w135 - 1, j - w135 - 1] == 0 and image[i + w315 + 1, j + w315 + 1] == 0:
-                        widths.append([i, j, 135, w135, w315])
-                        break
+    # only the center pixels are visited, in row-major order
+    for i, j in np.argwhere(center_img == 255).tolist():
+        w0 = 0
+        w45 = 0
+        w90 = 0
+        w135 = 0
+        w180 = 1
+        w225 = 1
+        w270 = 1
+        w315 = 1
+        while True:
+            if image[i, j + w0 + 1] != 0:
+                w0 += 1
+            if image[i, j - w180 - 1] != 0:
+                w180 += 1
+            if image[i - w90 - 1, j] != 0:
+                w90 += 1
+            if image[i + w270 + 1, j] != 0:
+                w270 += 1
+            if image[i - w45 - 1, j + w45 + 1] != 0:
+                w45 += 1
+            if image[i + w225 + 1, j - w225 - 1] != 0:
+                w225 += 1
+            if image[i - w135 - 1, j - w135 - 1] != 0:
+                w135 += 1
+            if image[i + w315 + 1, j + w315 + 1] != 0:
+                w315 += 1
+
+            if image[i, j + w0 + 1] == 0 and image[i, j - w180 - 1] == 0:
+                widths.append([i, j, 0, w0, w180])
+                break
+            elif image[i - w90 - 1, j] == 0 and image[i + w270 + 1, j] == 0:
+                widths.append([i, j, 90, w90, w270])
+                break
+            elif image[i - w45 - 1, j + w45 + 1] == 0 and image[i + w225 + 1, j - w225 - 1] == 0:
+                widths.append([i, j, 45, w45, w225])
+                break
+            elif image[i - w135 - 1, j - w135 - 1] == 0 and image[i + w315 + 1, j + w315 + 1] == 0:
+                widths.append([i, j, 135, w135, w315])
+                break
     return widths
 
 
+_lbp_offsets = [(-1, 0), (-1, 1), (0, 1), (1, 1), (1, 0), (1, -1), (0, -1), (-1, -1)]
+
+
 def _local_binary_pattern(window: list):
     x = [0, 0, 1, 2, 2, 2, 1, 0]
     y = [1, 2, 2, 2, 1, 0, 0, 0]
@@ -68,278 +96,414 @@ def _local_binary_pattern(window: list):
     center = window[1][1]
     for i in range(0, 8):
         if center >= window[x[i]][y[i]]:
-            decimal += np.power(2, i)
+            decimal += 1 << i
     return decimal
 
 
+def _local_binary_pattern_image(gray_img: np.ndarray):
+    # same neighbour order as _local_binary_pattern, computed for every pixel at once
+    padded = np.pad(gray_img, 1, mode='edge')
+    lbp = np.zeros(gray_img.shape, dtype=np.uint8)
+    for i, (dx, dy) in enumerate(_lbp_offsets):
+        neighbour = padded[1 + dx:1 + dx + gray_img.shape[0], 1 + dy:1 + dy + gray_img.shape[1]]
+        lbp |= (gray_img >= neighbour).astype(np.uint8) << i
+    return lbp
+
+
 def _preparing_data(widths: list, sections: int, original_img: np.ndarray, classified_img: np.ndarray,
                    bright_img: np.ndarray, gray_img: np.ndarray):
-    f_vectors = []
+    widths = np.array(widths, dtype=int).reshape(-1, 5)
+    keep = (widths[:, 3] + widths[:, 4]) >= 2
     if classified_img is not None:
-        for w in widths:
-            w0 = w[0]
-            w1 = w[1]
-            if (np.array_equal(classified_img[w0, w1], [255, 0, 0]) or np.array_equal(classified_img[w0, w1], [0, 0, 255])) \
-                    and ((w[3]+w[4]) >= 2):
-                if np.array_equal(classified_img[w0, w1], [255, 0, 0]):
-                    out = 0
-                elif np.array_equal(classified_img[w0, w1], [0, 0, 255]):
-                    out = 1
-
-                iv = _vector(w, sections, original_img, bright_img, gray_img, out)
-                f_vectors.append(iv)
+        colors = classified_img[widths[:, 0], widths[:, 1]]
+        veins = np.all(colors == [255, 0, 0], axis=1)
+        arteries = np.all(colors == [0, 0, 255], axis=1)
+        keep &= veins | arteries
+        out = arteries.astype(int)
     else:
-        for w in widths:
-            if (w[3] + w[4]) >= 2:
-                iv = _vector(w, sections, original_img, bright_img, gray_img, -1)
-                f_vectors.append(iv)
-
-    return f_vectors
-
-
-def _vector(w: list, sections: int, original_img: np.ndarray, bright_img: np.ndarray, gray_img: np.ndarray, out: int):
-    iv = []
-    w0 = w[0]
-    w1 = w[1]
-    angle = w[2]
-    section = (w[3] + w[4]) / sections
-    if angle == 0:
-        y = w1 + w[3]
-        iv.extend([w0, w1])
-        for i in range(0, sections + 1):
-            step = int(np.floor(y - (i * section)))
-            iv.extend(original_img[w0, step])
-            iv.extend([bright_img[w0, step]])
-            iv.extend([_local_binary_pattern(gray_img[w0 - 1:w0 + 2, step - 1:step + 2])])
-        iv.extend([w[3] + w[4]])
-        iv.extend([out])
-    elif angle == 45:
-        x = w0 - w[3]
-        y = w1 + w[3]
-        iv.extend([w0, w1])
-        for i in range(0, sections + 1):
-            stepx = int(np.floor(x + (i * section)))
-            stepy = int(np.floor(y - (i * section)))
-            iv.extend(original_img[stepx, stepy])
-            iv.extend([bright_img[stepx, stepy]])
-            iv.extend([_local_binary_pattern(gray_img[stepx - 1:stepx + 2, stepy - 1:stepy + 2])])
-        iv.extend([w[3] + w[4]])
-        iv.extend([out])
-    elif angle == 90:
-        x = w0 - w[3]
-        iv.extend([w0, w1])
-        for i in range(0, sections + 1):
-            step = int(np.floor(x + (i * section)))
-            iv.extend(original_img[step, w1])
-            iv.extend([bright_img[step, w1]])
-            iv.extend([_local_binary_pattern(gray_img[step - 1:step + 2, w1 - 1:w1 + 2])])
-        iv.extend([w[3] + w[4]])
-        iv.extend([out])
-    elif angle == 135:
-        x = w0 - w[3]
-        y = w1 - w[3]
-        iv.extend([w0, w1])
-        for i in range(0, sections + 1):
-            stepx = int(np.floor(x + (i * section)))
-            stepy = int(np.floor(y + (i * section)))
-            iv.extend(original_img[stepx, stepy])
-            iv.extend([bright_img[stepx, stepy]])
-            iv.extend([_local_binary_pattern(gray_img[stepx - 1:stepx + 2, stepy - 1:stepy + 2])])
-        iv.extend([w[3] + w[4]])
-        iv.extend([out])
-
-    return iv
-
-
-def _feature_vectors():
-    directory = _base_directory_training + "original/"
-    features = []
-    for filename in sorted(glob.glob(os.path.join(directory, '*.tif'))):
-        name = os.path.basename(filename)
-        name = name.split(".")[0]
-
-        original = cv2.imread(filename, 1)
-        gray = cv2.imread(filename, 0)
-        (minVal, maxVal, minLoc, maxLoc) = cv2.minMaxLoc(gray)
-
-        lab = cv2.cvtColor(original, cv2.COLOR_BGR2LAB)
-        L, A, B = cv2.split(lab)
-
-        manual = retina.Retina(None, _base_directory_training + "manual/" + name + ".png")
-        manual.threshold_image()
-        thr_img = manual.get_uint_image()
-        cv2.circle(thr_img, maxLoc, 60, 0, -1)
-        manual.skeletonization()
-        skeleton_img = manual.get_uint_image()
-        cv2.circle(skeleton_img, maxLoc, 60, 0, -1)
-        landmarks, segmented_skeleton_img = l.potential_landmarks(skeleton_img, 3)
-
-        av = cv2.imread(_base_directory_training + "av/" + name + ".png", 1)
-
-        widths = _vessel_widths(segmented_skeleton_img, thr_img)
-        data = _preparing_data(widths, 6, original, av, L, gray)
-        features.extend(data)
-
-    h5f = h5py.File(_base_directory_model + 'vector_features_interpolation.h5', 'w')
-    h5f.create_dataset('training', data=features)
-    return features
-
-
-def _loading_model(original: np.ndarray, threshold: np.ndarray, av: np.ndarray, size: int):
-    # Load model of the neuronal network
-    json_file = open(_base_directory_model + 'modelVA.json', "r")
-    loaded_model_json = json_file.read()
-    json_file.close()
-    loaded_model = model_from_json(loaded_model_json)
-
-    # Load weights
-    loaded_model.load_weights(_base_directory_model + 'modelVA.h5')
+        out = np.full(widths.shape[0], -1)
+
+    return _vectors(
+        widths[keep], sections, original_img, bright_img, _local_binary_pattern_image(gray_img), out[keep])
+
+
+def _vectors(widths: np.ndarray, sections: int, original_img: np.ndarray, bright_img: np.ndarray,
+             lbp_img: np.ndarray, out: np.ndarray):
+    # each vector is [x, y, (b, g, r, bright, lbp) for each section point, width, out]
+    rows = np.repeat(widths[:, 0:1], sections + 1, axis=1)
+    cols = np.repeat(widths[:, 1:2], sections + 1, axis=1)
+    steps = np.arange(0, sections + 1) * ((widths[:, 3:4] + widths[:, 4:5]) / sections)
+
+    angle = widths[:, 2] == 0
+    cols[angle] = np.floor((widths[angle, 1:2] + widths[angle, 3:4]) - steps[angle])
+    angle = widths[:, 2] == 45
+    rows[angle] = np.floor((widths[angle, 0:1] - widths[angle, 3:4]) + steps[angle])
+    cols[angle] = np.floor((widths[angle, 1:2] + widths[angle, 3:4]) - steps[angle])
+    angle = widths[:, 2] == 90
+    rows[angle] = np.floor((widths[angle, 0:1] - widths[angle, 3:4]) + steps[angle])
+    angle = widths[:, 2] == 135
+    rows[angle] = np.floor((widths[angle, 0:1] - widths[angle, 3:4]) + steps[angle])
+    cols[angle] = np.floor((widths[angle, 1:2] - widths[angle, 3:4]) + steps[angle])
+
+    vectors = np.empty((widths.shape[0], 5 * (sections + 1) + 4), dtype=int)
+    vectors[:, 0:2] = widths[:, 0:2]
+    samples = vectors[:, 2:-2].reshape(widths.shape[0], sections + 1, 5)
+    samples[:, :, 0:3] = original_img[rows, cols]
+    samples[:, :, 3] = bright_img[rows, cols]
+    samples[:, :, 4] = lbp_img[rows, cols]
+    vectors[:, -2] = widths[:, 3] + widths[:, 4]
+    vectors[:, -1] = out
+    return vectors
+
+
+def _vector(w: list, sections: int, original_img: np.ndarray, bright_img: np.ndarray, lbp_img: np.ndarray, out: int):
+    # the lbp image is calculated once per image with _local_binary_pattern_image, many vectors should use _vectors
+    return _vectors(np.array([w], dtype=int), sections, original_img, bright_img, lbp_img, np.array([out]))[0]
+
+
+def _image_features(arguments: tuple):
+    directory, name, sections = arguments
+    original = cv2.imread(directory + "original/" + name + ".tif", 1)
+    gray = cv2.imread(directory + "original/" + name + ".tif", 0)
+    (minVal, maxVal, minLoc, maxLoc) = cv2.minMaxLoc(gray)
+
+    lab = cv2.cvtColor(original, cv2.COLOR_BGR2LAB)
+    L, A, B = cv2.split(lab)
+
+    manual = retina.Retina._open_image(directory + "manual/" + name + ".png")
+    thr_img, segmented_skeleton_img = _mask_optic_disc(l.preprocessing(manual, 0), maxLoc)
+
+    av = cv2.imread(directory + "av/" + name + ".png", 1)
+
+    widths = _vessel_widths(segmented_skeleton_img, thr_img)
+    return name, _preparing_data(widths, sections, original, av, L, gray)
+
+
+def _append(dataset, data: np.ndarray):
+    start = dataset.shape[0]
+    dataset.resize(start + data.shape[0], axis=0)
+    dataset[start:] = data
+
+
+def _open_training_file(path: str, columns: int, resume: bool, attributes: dict):
+    if resume and os.path.isfile(path):
+        h5f = h5py.File(path, 'a')
+        if 'images' in h5f:
+            for name, value in attributes.items():
+                stored = h5f.attrs.get(name)
+                if stored != value:
+                    h5f.close()
+                    raise ValueError("Can not resume {}, it was built with {} '{}' instead of '{}'".format(
+                        path, name, stored, value))
+            # rows written after the last completed image belong to an interrupted one and are discarded
+            rows = np.count_nonzero(h5f['image'][:] < h5f['images'].shape[0])
+            h5f['training'].resize(rows, axis=0)
+            h5f['image'].resize(rows, axis=0)
+            return h5f
+        h5f.close()
+    h5f = h5py.File(path, 'w')
+    h5f.attrs.update(attributes)
+    h5f.create_dataset(
+        'training', shape=(0, columns), maxshape=(None, columns), dtype=int, chunks=(4096, columns),
+        compression='gzip')
+    h5f.create_dataset('image', shape=(0,), maxshape=(None,), dtype=int, chunks=(4096,), compression='gzip')
+    h5f.create_dataset('images', shape=(0,), maxshape=(None,), dtype=h5py.special_dtype(vlen=str))
+    return h5f
+
+
+def _feature_vectors(directory: str = _base_directory_training,
+                     output: str = _base_directory_model + 'vector_features_interpolation.h5',
+                     processes: int = None,
+                     resume: bool = False,
+                     sections: int = 6):
+    """
+    Builds the training set with the feature vectors of every image of the given directory, which must contain the
+    original, manual and av folders. Images are processed in parallel and the features of each image are appended to
+    the 'training' dataset of the output file as soon as they are ready, in the order in which they finish. The
+    'image' dataset stores for each row the position of its image name in the 'images' dataset. When resume is True,
+    images already in the output file are not processed again, the file must have been built from the same directory
+    and number of sections.
+    :return: the 'training' dataset of the output file as an array
+    """
+    names = [os.path.basename(filename).split(".")[0]
+             for filename in sorted(glob.glob(os.path.join(directory + "original/", '*.tif')))]
+    attributes = {'directory': os.path.abspath(directory), 'sections': sections}
+    with _open_training_file(output, 5 * (sections + 1) + 4, resume, attributes) as h5f:
+        done = [name.decode('utf-8') if isinstance(name, bytes) else name for name in h5f['images'][:]]
+        pending = [(directory, name, sections) for name in names if name not in done]
+        if pending:
+            with Pool(processes) as pool:
+                for name, data in pool.imap_unordered(_image_features, pending):
+                    _append(h5f['training'], data)
+                    _append(h5f['image'], np.full(data.shape[0], h5f['images'].shape[0]))
+                    _append(h5f['images'], np.array([name], dtype=object))
+                    h5f.flush()
+        return h5f['training'][:]
+
+
+def _mask_optic_disc(preprocessed: dict, center: tuple, radius: int = 60):
+    # removes the optic disc from the shared preprocessing, the cached images are never modified
+    if preprocessed["border_size"] != 0:
+        raise ValueError("Preprocessing must be done without border, got {}".format(preprocessed["border_size"]))
+    thr_img = preprocessed["threshold"].copy()
+    cv2.circle(thr_img, center, radius, 0, -1)
+    skeleton_img = preprocessed["skeleton"].copy()
+    cv2.circle(skeleton_img, center, radius, 0, -1)
+    segmented_skeleton_img = preprocessed["segmented"].copy()
+    cv2.circle(segmented_skeleton_img, center, radius, 0, -1)
+
+    # potential landmarks only look at 3x3 neighbourhoods, the pixels around the disc are the only ones that change
+    disc = np.zeros(skeleton_img.shape, dtype=np.uint8)
+    cv2.circle(disc, center, radius, 1, -1)
+    ring = (cv2.dilate(disc, np.ones((3, 3), np.uint8)) - disc).astype(bool)
+    binary = skeleton_img // 255
+    for it_x, it_y in zip(*np.where(ring & (skeleton_img == 255))):
+        if 1 <= it_x < binary.shape[0] - 1 and 1 <= it_y < binary.shape[1] - 1:
+            if np.sum(binary[it_x - 1:it_x + 2, it_y - 1:it_y + 2]) >= 4:
+                segmented_skeleton_img[it_x, it_y] = 0
+            else:
+                segmented_skeleton_img[it_x, it_y] = 255
+    return thr_img, segmented_skeleton_img
+
+
+def _segment_samples(connected_components, samples_per_segment: int):
+    """
+    Selects up to samples_per_segment evenly spaced pixels (in row-major order) of every connected component
+    :param connected_components: the output of cv2.connectedComponentsWithStats or a _LabelIndex
+    :param samples_per_segment: maximum number of pixels selected per component
+    :return: an uint8 image with the selected pixels in 255
+    """
+    if samples_per_segment < 1:
+        raise ValueError("samples_per_segment must be greater than zero")
+    label_index = _label_index(connected_components)
+    counts = np.diff(label_index.offsets)
+    labels = np.arange(1, counts.shape[0])
+    samples = np.minimum(counts[labels], samples_per_segment)
+    sample_labels = np.repeat(labels, samples)
+    # position of each sample inside its component, spread over the whole component
+    position = np.arange(sample_labels.shape[0]) - np.repeat(np.cumsum(samples) - samples, samples)
+    step = (counts[sample_labels] - 1) / np.maximum(np.repeat(samples, samples) - 1, 1)
+    flat = label_index.order[label_index.offsets[sample_labels] + np.round(position * step).astype(int)]
+    center_img = np.zeros(label_index.labels.shape, dtype=np.uint8)
+    center_img.flat[flat] = 255
+    return center_img
+
+
+def _majority(components: np.ndarray, labels: np.ndarray):
+    """
+    Counts the veins and arteries of every connected component
+    :param components: the label image of the connected components
+    :param labels: an A/V label map
+    :return: an array with the class of the majority of the classified pixels of each component, 0 for a tie, for
+             components without classified pixels and for the background (label 0), and an array with the number of
+             classified pixels of each component
+    """
+    n_veins = np.bincount(components[labels == evaluation.VEIN], minlength=components.max() + 1)
+    n_arteries = np.bincount(components[labels == evaluation.ARTERY], minlength=components.max() + 1)
+    majority = np.select([n_veins > n_arteries, n_arteries > n_veins], [evaluation.VEIN, evaluation.ARTERY], 0)
+    majority[0] = 0
+    return majority, n_veins + n_arteries
+
+
+def _segment_vote(connected_components, labels: np.ndarray):
+    """
+    Assigns to every pixel of a connected component the class (vein or artery) of the majority of its classified
+    pixels. Components without classified pixels or with a tie are not modified.
+    :param connected_components: the output of cv2.connectedComponentsWithStats or a _LabelIndex
+    :param labels: an A/V label map
+    :return: a copy of the label map with the vote of each component
+    """
+    components = _labels(connected_components)
+    result_image = labels.copy()
+    vote = _majority(components, result_image)[0]
+    mask = vote[components] != 0
+    result_image[mask] = vote[components[mask]]
+    return result_image
+
+
+def _loading_model(original: np.ndarray, threshold: np.ndarray, av: np.ndarray, size: int, preprocessed: dict = None,
+                   batch_size: int = _predict_batch_size, samples_per_segment: int = None):
+    return _predict(original, threshold, av, size, preprocessed, batch_size, samples_per_segment)[0:4]
+
+
+def _predict(original: np.ndarray, threshold: np.ndarray, av: np.ndarray, size: int, preprocessed: dict = None,
+             batch_size: int = _predict_batch_size, samples_per_segment: int = None):
+    # same as _loading_model, it also returns the connected components of the segmented skeleton so the later stages
+    # do not label it again
+    # the neuronal network is loaded only once per process
+    loaded_model = model_registry.get(_model_name)
 
     gray = cv2.cvtColor(original, cv2.COLOR_BGR2GRAY)
     (minVal, maxVal, minLoc, maxLoc) = cv2.minMaxLoc(gray)
     lab = cv2.cvtColor(original, cv2.COLOR_BGR2LAB)
     L, A, B = cv2.split(lab)
 
-    manual = retina.Retina(threshold, None)
-    manual.threshold_image()
-    thr_img = manual.get_uint_image()
-    cv2.circle(thr_img, maxLoc, 60, 0, -1)
-    manual.skeletonization()
-    skeleton_img = manual.get_uint_image()
-    cv2.circle(skeleton_img, maxLoc, 60, 0, -1)
-    landmarks, segmented_skeleton_img = l.potential_landmarks(skeleton_img, 3)
+    if preprocessed is None:
+        preprocessed = l.preprocessing(threshold, 0)
+    thr_img, segmented_skeleton_img = _mask_optic_disc(preprocessed, maxLoc)
+    connected_components = cv2.connectedComponentsWithStats(segmented_skeleton_img.astype(np.uint8), 4, cv2.CV_32S)
 
-    widths = _vessel_widths(segmented_skeleton_img, thr_img)
+    if samples_per_segment is None:
+        center_img = segmented_skeleton_img
+    else:
+        # only a few pixels of each segment are measured and classified
+        center_img = _segment_samples(connected_components, samples_per_segment)
+    widths = _vessel_widths(center_img, thr_img)
     data = _preparing_data(widths, 6, original, av, L, gray)
 
     features = np.array(data)
     predict_img = np.full((segmented_skeleton_img.shape[0], segmented_skeleton_img.shape[1]), 3, dtype=float)
 
-    for row in range(0, features.shape[0]):
-        prediction = loaded_model.predict(np.divide(features[row:row + 1, 2:size], 255), batch_size=1)
-        predict_img[features[row, 0], features[row, 1]] = prediction
-
-    return features, segmented_skeleton_img, thr_img, predict_img
+    if features.shape[0] > 0:
+        predictions = loaded_model.predict(np.divide(features[:, 2:size], 255), batch_size=batch_size)
+        predict_img[features[:, 0], features[:, 1]] = predictions[:, 0]
+
+    return features, segmented_skeleton_img, thr_img, predict_img, connected_components
+
+
+def threshold_sweep(features: np.ndarray, predicted_img: np.ndarray, size: int, thresholds: np.ndarray = None):
+    """
+    Evaluates the network predictions against the expected classes for every threshold. A prediction is classified
+    as artery when it is greater or equal than the threshold and as vein otherwise. The predictions are sorted only
+    once, the counts for every threshold are taken from the sorted arrays.
+
+    :param features: the feature vectors, with the expected class at the size column
+    :param predicted_img: an image with the network prediction for each feature vector position
+    :param size: column of the features with the expected class (1 for arteries and 0 for veins)
+    :param thresholds: the thresholds to evaluate, by default [0, 0.001, ..., 0.999]
+    :return: a dictionary with the thresholds and the accuracy, true positives, true negatives, false positives and
+             false negatives for each one of them
+    """
+    if thresholds is None:
+        thresholds = np.arange(0, 1000) * 0.001
+    predictions = predicted_img[features[:, 0], features[:, 1]]
+    arteries = np.sort(predictions[features[:, size] == 1])
+    veins = np.sort(predictions[features[:, size] == 0])
+    false_negative = np.searchsorted(arteries, thresholds, side='left')
+    true_negative = np.searchsorted(veins, thresholds, side='left')
+    true_positive = arteries.shape[0] - false_negative
+    false_positive = veins.shape[0] - true_negative
+    return {
+        "thresholds": thresholds,
+        "accuracy": (100 * (true_positive + true_negative)) / features.shape[0],
+        "true_positive": true_positive,
+        "true_negative": true_negative,
+        "false_positive": false_positive,
+        "false_negative": false_negative}
+
+
+def render_labels(labels: np.ndarray, image: np.ndarray = None):
+    """
+    Renders an A/V label map as a BGR image through a palette lookup
+    :param labels: an uint8 image with evaluation.BACKGROUND, evaluation.VEIN, evaluation.ARTERY or SKELETON in each
+                   pixel
+    :param image: optional BGR image to draw the veins and arteries over, the rest of its pixels are not modified
+    :return: an uint8 BGR image
+    """
+    if image is None:
+        return _palette[labels]
+    rendered = image.copy()
+    mask = (labels == evaluation.VEIN) | (labels == evaluation.ARTERY)
+    rendered[mask] = _palette[labels[mask]]
+    return rendered
+
+
+def _prediction_labels(features: np.ndarray, skeleton_img: np.ndarray, predicted_img: np.ndarray, threshold: float):
+    labels = np.where(skeleton_img == 255, SKELETON, evaluation.BACKGROUND).astype(np.uint8)
+    predictions = predicted_img[features[:, 0], features[:, 1]]
+    labels[features[:, 0], features[:, 1]] = np.where(predictions >= threshold, evaluation.ARTERY, evaluation.VEIN)
+    return labels
+
+
+def _render_prediction(features: np.ndarray, skeleton_img: np.ndarray, original_img: np.ndarray,
+                       predicted_img: np.ndarray, threshold: float):
+    labels = _prediction_labels(features, skeleton_img, predicted_img, threshold)
+    network_prediction = np.where(labels == SKELETON, evaluation.BACKGROUND, labels).astype(float)
+    return render_labels(labels), network_prediction, render_labels(labels, original_img)
 
 
 def _validating_model(features: np.ndarray, skeleton_img: np.ndarray, original_img: np.ndarray, predicted_img: np.ndarray, size: int, av: int):
-    max_acc = -1
-    rgb_prediction = []
-    network_prediction = []
-    original = []
     if av == 0:
-        manual_copy = retina.Retina(skeleton_img, None)
-        manual_copy.bin_to_bgr()
-        manual_copy = manual_copy.get_uint_image()
-        original_copy = original_img.copy()
-        predict_copy = predicted_img.copy()
-        mask0 = predict_copy == 3
-        mask1 = (predict_copy >= 0) & (predict_copy < 0.8)
-        mask2 = (predict_copy >= 0.8) & (predict_copy <= 1)
-        predict_copy[mask1] = 1
-        predict_copy[mask2] = 2
-        predict_copy[mask0] = 0
-        for row in range(0, features.shape[0]):
-            if predict_copy[features[row, 0], features[row, 1]] == 2:
-                manual_copy[features[row, 0], features[row, 1]] = [0, 0, 255]
-                original_copy[features[row, 0], features[row, 1]] = [0, 0, 255]
-            elif predict_copy[features[row, 0], features[row, 1]] == 1:
-                manual_copy[features[row, 0], features[row, 1]] = [255, 0, 0]
-                original_copy[features[row, 0], features[row, 1]] = [255, 0, 0]
-
-        rgb_prediction = manual_copy
-        network_prediction = predict_copy
-        original = original_copy
+        max_acc = -1
+        rgb_prediction, network_prediction, original = _render_prediction(
+            features, skeleton_img, original_img, predicted_img, 0.8)
     else:
-        for i in range(0, 1000):
-            manual_copy = retina.Retina(skeleton_img, None)
-            manual_copy.bin_to_bgr()
-            manual_copy = manual_copy.get_uint_image()
-            original_copy = original_img.copy()
-            predict_copy = predicted_img.copy()
-            k = 0.001*i
-            mask0 = predict_copy == 3
-            mask1 = (predict_copy >= 0) & (predict_copy < k)
-            mask2 = (predict_copy >= k) & (predict_copy <= 1)
-            predict_copy[mask1] = 1
-            predict_copy[mask2] = 2
-            predict_copy[mask0] = 0
-            true_positive = 0
-            true_negative = 0
-            false_positive = 0
-            false_negative = 0
-            for row in range(0, features.shape[0]):
-                if predict_copy[features[row, 0], features[row, 1]] == 2:
-                    manual_copy[features[row, 0], features[row, 1]] = [0, 0, 255]
-                    original_copy[features[row, 0], features[row, 1]] = [0, 0, 255]
-                elif predict_copy[features[row, 0], features[row, 1]] == 1:
-                    manual_copy[features[row, 0], features[row, 1]] = [255, 0, 0]
-                    original_copy[features[row, 0], features[row, 1]] = [255, 0, 0]
-
-                if int(predict_copy[features[row, 0], features[row, 1]]) == 1 and features[row, size] == 0:
-                    true_negative += 1
-                elif int(predict_copy[features[row, 0], features[row, 1]]) == 2 and features[row, size] == 1:
-                    true_positive += 1
-                elif int(predict_copy[features[row, 0], features[row, 1]]) == 2 and features[row, size] == 0:
-                    false_positive += 1
-                elif int(predict_copy[features[row, 0], features[row, 1]]) == 1 and features[row, size] == 1:
-                    false_negative += 1
-
-            accy = (100 * (true_positive+true_negative)) / features.shape[0]
-            if max_acc < accy:
-                max_acc = accy
-                rgb_prediction = manual_copy
-                network_prediction = predict_copy
-                original = original_copy
+        sweep = threshold_sweep(features, predicted_img, size)
+        best = int(np.argmax(sweep["accuracy"]))
+        max_acc = float(sweep["accuracy"][best])
+        rgb_prediction, network_prediction, original = _render_prediction(
+            features, skeleton_img, original_img, predicted_img, sweep["thresholds"][best])
 
     return max_acc, rgb_prediction, network_prediction, original
 
 
+def _homogenize_labels(connected_components, labels: np.ndarray):
+    """
+    Assigns to every connected component the class (vein or artery) of the majority of its pixels. Components with a
+    tie or with a single classified pixel are not modified.
+    :param connected_components: the output of cv2.connectedComponentsWithStats or a _LabelIndex
+    :param labels: an A/V label map
+    :return: a homogenized copy of the label map
+    """
+    result_image = labels.copy()
+    components = _labels(connected_components)
+    majority, classified = _majority(components, result_image)
+    homogenize = (majority != 0) & (classified > 1)
+    mask = homogenize[components]
+    result_image[mask] = majority[components[mask]]
+    return result_image
+
+
 def _homogenize(connected_components: np.ndarray,
                 network_prediction: np.ndarray,
                 rgb_prediction: np.ndarray,
                 original: np.ndarray):
-    # Imagen en con 0, 1, 2
-    result_image = network_prediction.copy()
-    # Imagen a color del resultado de la red
-    final_image = rgb_prediction.copy()
-    img_rgb = original.copy()
-
-    for x in range(1, connected_components[0]):
-        mask = connected_components[1] != x
-        mask2 = connected_components[1] == x
-        result_image_copy = result_image.copy()
-        result_image_copy[mask] = 0
-        n_veins = np.count_nonzero(result_image_copy == 1)
-        n_arteries = np.count_nonzero(result_image_copy == 2)
-
-        if n_veins == 0 and n_arteries == 0:
-            pass
-        elif n_veins == n_arteries:
-            pass
-        elif (n_veins == 1 and n_arteries == 0) or (n_veins == 0 and n_arteries == 1):
-            pass
-        elif n_veins > n_arteries:
-            result_image[mask2] = 1
-        else:
-            result_image[mask2] = 2
+    labels = _homogenize_labels(connected_components, network_prediction.astype(np.uint8))
+    return render_labels(labels, rgb_prediction), render_labels(labels, original)
+
+
+class _LabelIndex(object):
+    """
+    Index with the pixels of every connected component. The flat pixel positions are sorted by label, so the pixels
+    of a component are a contiguous range (in row-major order) given by the label offsets.
 
-    for row in range(0, result_image.shape[0]):
-        for col in range(0, result_image.shape[1]):
-            if result_image[row, col] == 1:
-                final_image[row, col] = [255, 0, 0]
-                img_rgb[row, col] = [255, 0, 0]
-            elif result_image[row, col] == 2:
-                final_image[row, col] = [0, 0, 255]
-                img_rgb[row, col] = [0, 0, 255]
+    :param connected_components: the output of cv2.connectedComponentsWithStats
+    """
+    def __init__(self, connected_components: tuple):
+        self.labels = connected_components[1]
+        self.stats = connected_components[2]
+        flat = self.labels.ravel()
+        self.order = np.argsort(flat, kind='stable')
+        self.offsets = np.zeros(connected_components[0] + 1, dtype=int)
+        np.cumsum(np.bincount(flat, minlength=connected_components[0]), out=self.offsets[1:])
 
-    return final_image, img_rgb
+    def pixels(self, label: int):
+        """Returns a (n, 2) array with the row and column of every pixel of the given label"""
+        flat = self.order[self.offsets[label]:self.offsets[label + 1]]
+        return np.column_stack(np.divmod(flat, self.labels.shape[1]))
 
+    def bounding_box(self, label: int):
+        """Returns the [x, y, width, height] box of the given label"""
+        return self.stats[label, [cv2.CC_STAT_LEFT, cv2.CC_STAT_TOP, cv2.CC_STAT_WIDTH, cv2.CC_STAT_HEIGHT]]
 
-def _box_labels(bifurcations: list, c_components: np.ndarray):
+
+def _label_index(connected_matrix):
+    if isinstance(connected_matrix, _LabelIndex):
+        return connected_matrix
+    return _LabelIndex(connected_matrix)
+
+
+def _labels(connected_matrix):
+    # the label image alone does not need the sorted index
+    if isinstance(connected_matrix, _LabelIndex):
+        return connected_matrix.labels
+    return connected_matrix[1]
+
+
+def _box_labels(bifurcations: list, c_components):
+    labels = _labels(c_components)
     connected_vessels = []
     for b in bifurcations:
-        labels = c_components[1]
         box = labels[b[1]-1:b[3]+1, b[0]-1:b[2]+1]
         unique = np.unique(box)
         if len(unique) == 4:
@@ -355,40 +519,50 @@ def _average(widths: list):
     return acum
 
 
-def _normalize_indexes(connected_matrix: np.ndarray, label: int):
-    labeled = connected_matrix[1]
-    indexes = np.where(labeled == label)
-    formatted_index = []
-    for i in range(0, len(indexes[0])):
-        formatted_index.append([indexes[0][i], indexes[1][i]])
+def _normalize_indexes(connected_matrix, label: int):
+    return _label_index(connected_matrix).pixels(label)
 
-    return formatted_index
 
-
-def _average_width(connected_matrix: np.ndarray, connected: list, thr_img: np.ndarray, final_image: np.ndarray):
+def _average_width(connected_matrix, connected: list, thr_img: np.ndarray, final_image: np.ndarray):
+    label_index = _label_index(connected_matrix)
     connected_avg = []
     for c in connected:
-        formatted_indexes = _normalize_indexes(connected_matrix, c)
+        formatted_indexes = label_index.pixels(c)
         label_widths = l.vessel_width(thr_img, formatted_indexes)
         index = int(len(formatted_indexes)/2)
         connected_avg.extend([_average(label_widths), final_image[formatted_indexes[index][0], formatted_indexes[index][1]]])
     return connected_avg
 
 
-def _coloring(connected_matrix: np.ndarray, box: list, rgb: list, skeleton: np.ndarray):
+def _coloring(connected_matrix, box: list, rgb: list, skeleton: np.ndarray):
+    label_index = _label_index(connected_matrix)
     for segment_label in box:
-        formatted_indexes = _normalize_indexes(connected_matrix, segment_label)
-        for index in formatted_indexes:
-            skeleton[index[0], index[1]] = rgb
-    return skeleton[index[0], index[1]]
-
-
-def _postprocessing(connected_components: np.ndarray, thr_img: np.ndarray, bifurcs: list, final_img: np.ndarray):
+        formatted_indexes = label_index.pixels(segment_label)
+        skeleton[formatted_indexes[:, 0], formatted_indexes[:, 1]] = rgb
+    return skeleton[formatted_indexes[-1, 0], formatted_indexes[-1, 1]]
+
+
+def _postprocessing(connected_components, thr_img: np.ndarray, bifurcs: list, final_img: np.ndarray):
+    """
+    Fixes the classes of the segments that meet at each bifurcation, the widest segment gives its value to the other
+    ones unless only one of them is classified
+    :param connected_components: the output of cv2.connectedComponentsWithStats or a _LabelIndex
+    :param thr_img: the thresholded vessel segmentation
+    :param bifurcs: the bifurcation boxes found by landmarks.classification
+    :param final_img: an A/V label map or a BGR image with the veins and arteries coloured
+    :return: a corrected copy of final_img
+    """
+    if final_img.ndim == 2:
+        # the skeleton pixels that were not classified are SKELETON, as they are rendered in white
+        vein, artery, unclassified = evaluation.VEIN, evaluation.ARTERY, SKELETON
+    else:
+        vein, artery, unclassified = evaluation.VEIN_COLOR, evaluation.ARTERY_COLOR, [255, 255, 255]
     rgb = final_img.copy()
-
     connected_vessels = _box_labels(bifurcs, connected_components)
+    if connected_vessels:
+        label_index = _label_index(connected_components)
     for triplet in connected_vessels:
-        width_and_color = _average_width(connected_components, triplet, thr_img, rgb)
+        width_and_color = _average_width(label_index, triplet, thr_img, rgb)
         red = [0, 0]
         blue = [0, 0]
         maxwidth = [-1, -1]
@@ -398,55 +572,46 @@ def _postprocessing(connected_components: np.ndarray, thr_img: np.ndarray, bifur
             if width*1.75 > maxwidth[0]:
                 maxwidth[0] = width
                 maxwidth[1] = width_and_color[i]
-            if all(width_and_color[i] == [255, 0, 0]):
+            if np.array_equal(width_and_color[i], vein):
                 blue[0] += 1
                 blue[1] = width
-            elif all(width_and_color[i] == [0, 0, 255]):
+            elif np.array_equal(width_and_color[i], artery):
                 red[0] += 1
                 red[1] = width
 
         if (red[0]+blue[0]) == 1:
             pass
         else:
-            if not(all(maxwidth[1] == [255, 255, 255])):
-                _coloring(connected_components, triplet, maxwidth[1], rgb)
+            if not np.array_equal(maxwidth[1], unclassified):
+                _coloring(label_index, triplet, maxwidth[1], rgb)
 
     return rgb
 
 
 def _accuracy(post_img: np.ndarray, segmented_img: np.ndarray, gt_img: np.ndarray):
-    counter = 0
-    TN = 0
-    FN = 0
-    FP = 0
-    TP = 0
-    for it_x in range(0, segmented_img.shape[0]):
-        for it_y in range(0, segmented_img.shape[1]):
-            if segmented_img[it_x, it_y] == 255:
-                if (all(gt_img[it_x, it_y] == [255, 0, 0]) or all(gt_img[it_x, it_y] == [0, 0, 255])) and \
-                        not(all(post_img[it_x, it_y] == [255, 255, 255])):
-                    counter += 1
-                    if all(post_img[it_x, it_y] == [0, 0, 255]) and all(gt_img[it_x, it_y] == [0, 0, 255]):
-                        TP += 1
-                    elif all(post_img[it_x, it_y] == [255, 0, 0]) and all(gt_img[it_x, it_y] == [255, 0, 0]):
-                        TN += 1
-                    elif all(post_img[it_x, it_y] == [0, 0, 255]) and all(gt_img[it_x, it_y] == [255, 0, 0]):
-                        FP += 1
-                    elif all(post_img[it_x, it_y] == [255, 0, 0]) and all(gt_img[it_x, it_y] == [0, 0, 255]):
-                        FN += 1
-
-    sensitivity = TP / (TP + FN)
-    specificity = TN / (FP + TN)
-    accy = (TP + TN) / (TP + TN + FP + FN)
-    return [accy, sensitivity, specificity]
-
-
-def classification(original_img: np.ndarray, manual_img: np.ndarray):
-    manual = manual_img
-    bifurcations, crossings = l.classification(manual, 0)
-    features, sectioned_img, thr_img, predict_img = _loading_model(original_img, manual, None, 38)
-    acc, rgb, network, original = _validating_model(features, sectioned_img, original_img, predict_img, 38, 0)
-    connected_components = cv2.connectedComponentsWithStats(sectioned_img.astype(np.uint8), 4, cv2.CV_32S)
-    final_img, img_original = _homogenize(connected_components, network, rgb, original)
-    post_img = _postprocessing(connected_components, thr_img, bifurcations, img_original)
-    return post_img
+    # arteries are the positive class, only skeleton pixels classified in both images are evaluated
+    result = evaluation.evaluate_av(post_img, gt_img, segmented_img == 255)
+    return [result["accuracy"], result["sensitivity"], result["specificity"]]
+
+
+def classification(original_img: np.ndarray, manual_img: np.ndarray, samples_per_segment: int = None):
+    """
+    Classifies the vessels of the manual segmentation in arteries (red) and veins (blue)
+    :param original_img: the BGR retinal image
+    :param manual_img: the vessel segmentation of the image
+    :param samples_per_segment: if given, only this number of pixels of each skeleton segment is classified and the
+                                segment takes the class of the majority of them. By default every pixel is classified.
+    :return: the original image with the classified vessel skeleton
+    """
+    # both stages work over the same thresholded and skeletonized manual image
+    preprocessed = l.preprocessing(manual_img, 0)
+    bifurcations, crossings = l.classification(manual_img, 0, preprocessed)
+    features, sectioned_img, thr_img, predict_img, connected_components = _predict(
+        original_img, manual_img, None, 38, preprocessed, samples_per_segment=samples_per_segment)
+    # the intermediate stages work over a label map, it is rendered over the original image only at the end
+    labels = _prediction_labels(features, sectioned_img, predict_img, 0.8)
+    if samples_per_segment is not None:
+        labels = _segment_vote(connected_components, labels)
+    labels = _homogenize_labels(connected_components, labels)
+    labels = _postprocessing(connected_components, thr_img, bifurcations, labels)
+    return render_labels(labels, original_img)
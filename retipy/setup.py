@@ -33,5 +33,6 @@ setup(
         'Programming Language :: Python :: 3.7'
     ],
     packages=find_packages(exclude=["test", "util"]),
+    entry_points={"console_scripts": ["retipy-segment=retipy.batch:main"]},
     install_requires=['matplotlib', 'numpy', 'pillow', 'scikit-image', 'scipy', 'h5py', 'scikit-learn', 'tensorflow', 'keras']
     )
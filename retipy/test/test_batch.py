@@ -0,0 +1,99 @@
+# Retipy - Retinal Image Processing on Python
+# Copyright (C) 2018  Alejandro Valdes
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""tests for batch module"""
+
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+import numpy as np
+from numpy.testing import assert_array_equal
+from PIL import Image
+from retipy import batch, retina_grayscale
+
+
+class TestBatch(TestCase):
+    _resources = 'retipy/resources/images/'
+    _image_path = _resources + 'original.tif'
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.input = os.path.join(self.directory, "input")
+        self.output = os.path.join(self.directory, "output")
+        os.makedirs(self.input)
+        self.images = []
+        for name in ["a.tif", "b.tif"]:
+            shutil.copy(self._image_path, os.path.join(self.input, name))
+            self.images.append(os.path.join(self.input, name))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_find_images(self):
+        open(os.path.join(self.input, "notes.txt"), "w").close()
+        file_list = os.path.join(self.directory, "list.txt")
+        with open(file_list, "w") as list_file:
+            list_file.write(self.images[0] + "\n\nextra.png\n")
+        self.assertEqual(self.images, batch.find_images([self.input]))
+        self.assertEqual(self.images + ["extra.png"], batch.find_images([self.input], file_list))
+
+    def test_segment_images(self):
+        entries = batch.segment_images(self.images, self.output, processes=1)
+        self.assertEqual(["a", "b"], sorted(entries))
+        image = np.array(Image.open(self._image_path).convert("RGB"))
+        expected = retina_grayscale.Retina_grayscale(image, None).double_segmentation()
+        for name in ["a", "b"]:
+            self.assertEqual("done", entries[name]["status"])
+            self.assertIn("total", entries[name]["timings"])
+            assert_array_equal(expected, np.array(Image.open(os.path.join(self.output, name + ".png"))))
+        self.assertEqual(entries, batch.read_manifest(os.path.join(self.output, batch.MANIFEST_NAME)))
+
+    def test_segment_images_resume(self):
+        manifest_path = os.path.join(self.output, batch.MANIFEST_NAME)
+        batch.segment_images(self.images[:1], self.output, processes=1)
+        # a run stopped while writing the manifest leaves a partial line
+        with open(manifest_path, "a") as manifest:
+            manifest.write('{"name": "b", "sta')
+
+        finished = []
+        entries = batch.segment_images(self.images, self.output, processes=1, callback=finished.append)
+        self.assertEqual(["b"], [entry["name"] for entry in finished])
+        self.assertEqual("done", entries["a"]["status"])
+        self.assertEqual("done", entries["b"]["status"])
+
+        os.remove(os.path.join(self.output, "a.png"))
+        finished = []
+        batch.segment_images(self.images, self.output, processes=1, callback=finished.append)
+        self.assertEqual(["a"], [entry["name"] for entry in finished])
+
+    def test_segment_images_errors(self):
+        broken = os.path.join(self.input, "broken.png")
+        with open(broken, "w") as broken_file:
+            broken_file.write("not an image")
+        entries = batch.segment_images([broken], self.output, processes=1)
+        self.assertEqual("error", entries["broken"]["status"])
+        self.assertFalse(os.path.exists(os.path.join(self.output, "broken.png")))
+        self.assertEqual(1, batch.main(["-o", self.output, "-p", "1", broken]))
+
+        other = os.path.join(self.directory, "a.tif")
+        shutil.copy(self._image_path, other)
+        self.assertRaises(ValueError, batch.segment_images, [self.images[0], other], self.output)
+
+    def test_main(self):
+        self.assertEqual(0, batch.main(["-o", self.output, "-p", "1", "--fast", self.input]))
+        self.assertTrue(os.path.exists(os.path.join(self.output, "a.png")))
+        self.assertTrue(os.path.exists(os.path.join(self.output, "b.png")))
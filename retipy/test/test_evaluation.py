@@ -0,0 +1,114 @@
+# Retipy - Retinal Image Processing on Python
+# Copyright (C) 2018  Alejandro Valdes
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""tests for evaluation module"""
+
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+import cv2
+import numpy as np
+from numpy.testing import assert_array_equal
+from retipy import evaluation
+
+
+class TestEvaluation(TestCase):
+    _resources = 'retipy/resources/images/'
+
+    def setUp(self):
+        self.prediction = np.array([[1, 1, 0], [0, 1, 0], [1, 0, 0]])
+        self.ground_truth = np.array([[1, 0, 0], [0, 1, 1], [1, 1, 0]])
+
+    def test_confusion_matrix(self):
+        confusion = evaluation.confusion_matrix(self.prediction, self.ground_truth)
+        self.assertEqual(
+            {"true_positive": 3, "true_negative": 3, "false_positive": 1, "false_negative": 2}, confusion)
+
+    def test_confusion_matrix_mask(self):
+        mask = np.array([[1, 1, 1], [1, 1, 1], [0, 0, 0]])
+        confusion = evaluation.confusion_matrix(self.prediction, self.ground_truth, mask)
+        self.assertEqual(
+            {"true_positive": 2, "true_negative": 2, "false_positive": 1, "false_negative": 1}, confusion)
+
+    def test_metrics(self):
+        result = evaluation.metrics(evaluation.confusion_matrix(self.prediction, self.ground_truth))
+        self.assertEqual(3 / 5, result["sensitivity"])
+        self.assertEqual(3 / 4, result["specificity"])
+        self.assertEqual(6 / 9, result["accuracy"])
+        self.assertEqual(6 / 9, result["dice"])
+
+    def test_metrics_empty(self):
+        result = evaluation.metrics(evaluation.confusion_matrix(np.zeros((2, 2)), np.zeros((2, 2))))
+        self.assertTrue(np.isnan(result["sensitivity"]))
+        self.assertEqual(1, result["specificity"])
+
+    def test_av_labels(self):
+        image = np.array([[[255, 0, 0], [0, 0, 255]], [[255, 255, 255], [0, 0, 0]]])
+        assert_array_equal([[evaluation.VEIN, evaluation.ARTERY], [evaluation.BACKGROUND, evaluation.BACKGROUND]],
+                           evaluation.av_labels(image))
+
+    def test_evaluate_av(self):
+        av = cv2.imread(self._resources + 'av.png', 1)
+        result = evaluation.evaluate_av(av, av)
+        self.assertEqual(0, result["false_positive"] + result["false_negative"])
+        self.assertEqual(1, result["accuracy"])
+
+    def test_evaluate_directory(self):
+        directory = tempfile.mkdtemp()
+        try:
+            os.mkdir(os.path.join(directory, 'prediction'))
+            os.mkdir(os.path.join(directory, 'truth'))
+            image = cv2.imread(self._resources + 'manual.png', 0)
+            cv2.imwrite(os.path.join(directory, 'prediction', 'a.png'), image)
+            cv2.imwrite(os.path.join(directory, 'truth', 'a.png'), image)
+            cv2.imwrite(os.path.join(directory, 'prediction', 'b.png'), 255 - image)
+            cv2.imwrite(os.path.join(directory, 'truth', 'b.png'), image)
+            cv2.imwrite(os.path.join(directory, 'prediction', 'c.png'), image)
+            results = evaluation.evaluate_directory(
+                os.path.join(directory, 'prediction'), os.path.join(directory, 'truth'), processes=2)
+        finally:
+            shutil.rmtree(directory)
+
+        self.assertEqual(['a', 'b'], sorted(results.keys()))
+        self.assertEqual(1, results['a']['dice'])
+        self.assertEqual(0, results['b']['accuracy'])
+
+    def test_evaluate_directory_names(self):
+        directory = tempfile.mkdtemp()
+        try:
+            os.mkdir(os.path.join(directory, 'prediction'))
+            os.mkdir(os.path.join(directory, 'truth'))
+            image = cv2.imread(self._resources + 'manual.png', 0)
+            cv2.imwrite(os.path.join(directory, 'prediction', 'a[1].png'), image)
+            cv2.imwrite(os.path.join(directory, 'truth', 'a[1].png'), image)
+            cv2.imwrite(os.path.join(directory, 'truth', 'a1.png'), 255 - image)
+            results = evaluation.evaluate_directory(
+                os.path.join(directory, 'prediction'), os.path.join(directory, 'truth'), processes=1)
+
+            with open(os.path.join(directory, 'truth', 'a[1].png'), 'w') as broken:
+                broken.write('not an image')
+            self.assertRaises(
+                ValueError, evaluation.evaluate_directory, os.path.join(directory, 'prediction'),
+                os.path.join(directory, 'truth'), processes=1)
+        finally:
+            shutil.rmtree(directory)
+
+        self.assertEqual(['a[1]'], list(results.keys()))
+        self.assertEqual(1, results['a[1]']['dice'])
+
+    def test_evaluate_directory_wrong_mode(self):
+        self.assertRaises(ValueError, evaluation.evaluate_directory, 'a', 'b', 'other')
@@ -115,3 +115,16 @@ class TestLandmarks(TestCase):
 
 
 
+
+    def test_classification_preprocessed(self):
+        preprocessed = l.preprocessing(self.image.np_image, 2)
+        bifurcations, crossings = l.classification(self.image.np_image, 2, preprocessed)
+        result = np.genfromtxt(self._test_path + "boxes_bifurcations_test.csv", delimiter=',')
+        result2 = np.genfromtxt(self._test_path + "boxes_crossings_test.csv", delimiter=',')
+
+        assert_array_equal(result, bifurcations[0], "Bifurcation points does not match")
+        assert_array_equal(result2, crossings[0], "Crossing points does not match")
+
+    def test_classification_preprocessed_wrong_border(self):
+        preprocessed = l.preprocessing(self.image.np_image, 0)
+        self.assertRaises(ValueError, l.classification, self.image.np_image, 2, preprocessed)
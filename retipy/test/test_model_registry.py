@@ -0,0 +1,83 @@
+# Retipy - Retinal Image Processing on Python
+# Copyright (C) 2018  Alejandro Valdes
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""tests for model registry module"""
+
+import os
+import shutil
+import tempfile
+import threading
+from unittest import TestCase
+from retipy import model_registry
+
+
+class TestModelRegistry(TestCase):
+    _model_path = 'retipy/retipy/model/'
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        shutil.copy(self._model_path + 'modelVA.json', self.directory)
+        shutil.copy(self._model_path + 'modelVA.h5', self.directory)
+        self.weights = os.path.join(self.directory, 'modelVA.h5')
+        model_registry.register('test', os.path.join(self.directory, 'modelVA.json'), self.weights)
+
+    def tearDown(self):
+        model_registry.unload('test')
+        shutil.rmtree(self.directory)
+
+    def test_get_loads_once(self):
+        model = model_registry.get('test')
+        self.assertIs(model, model_registry.get('test'))
+
+    def test_get_not_registered(self):
+        self.assertRaises(ValueError, model_registry.get, 'not_registered')
+
+    def test_get_reloads_changed_weights(self):
+        model = model_registry.get('test')
+        mtime = os.path.getmtime(self.weights)
+        os.utime(self.weights, (mtime + 10, mtime + 10))
+        self.assertIsNot(model, model_registry.get('test'))
+
+    def test_get_without_reload(self):
+        model_registry.register('test', os.path.join(self.directory, 'modelVA.json'), self.weights, False)
+        model = model_registry.get('test')
+        mtime = os.path.getmtime(self.weights)
+        os.utime(self.weights, (mtime + 10, mtime + 10))
+        self.assertIs(model, model_registry.get('test'))
+
+    def test_get_threads(self):
+        models = []
+        threads = [threading.Thread(target=lambda: models.append(model_registry.get('test'))) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(4, len(models))
+        for model in models:
+            self.assertIs(models[0], model)
+
+    def test_preload_and_unload(self):
+        model_registry.preload(['test'])
+        model = model_registry.get('test')
+        model_registry.unload('test')
+        self.assertIsNot(model, model_registry.get('test'))
+
+    def test_versions(self):
+        version = model_registry.versions()['test']
+        self.assertEqual([self.weights, os.path.getmtime(self.weights), model_registry.default_backend], version)
+        mtime = os.path.getmtime(self.weights)
+        os.utime(self.weights, (mtime + 10, mtime + 10))
+        self.assertNotEqual(version, model_registry.versions()['test'])
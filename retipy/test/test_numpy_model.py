@@ -0,0 +1,87 @@
+# Retipy - Retinal Image Processing on Python
+# Copyright (C) 2018  Alejandro Valdes
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""tests for numpy model module"""
+
+import json
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+import numpy as np
+from numpy.testing import assert_allclose, assert_array_equal
+from retipy import model_registry
+from retipy import numpy_model
+
+
+class TestNumpyModel(TestCase):
+    _model_path = 'retipy/retipy/model/'
+    _json = _model_path + 'modelVA.json'
+    _weights = _model_path + 'modelVA.h5'
+
+    def setUp(self):
+        self.input = np.random.RandomState(0).rand(500, 36)
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_predict_matches_keras(self):
+        model_registry.register('test_keras', self._json, self._weights, backend=model_registry.BACKEND_KERAS)
+        expected = model_registry.get('test_keras').predict(self.input, batch_size=128)
+        model_registry.unload('test_keras')
+        result = numpy_model.NumpyModel.from_keras(self._json, self._weights).predict(self.input)
+
+        self.assertEqual(expected.shape, result.shape)
+        assert_allclose(expected, result, rtol=1e-5, atol=1e-6)
+
+    def test_predict_batch_size(self):
+        model = numpy_model.NumpyModel.from_keras(self._json, self._weights)
+        assert_allclose(model.predict(self.input), model.predict(self.input, batch_size=7), rtol=1e-5, atol=1e-6)
+
+    def test_convert(self):
+        output = os.path.join(self.directory, 'modelVA.npz')
+        numpy_model.convert(self._json, self._weights, output)
+        model = numpy_model.load(None, output)
+
+        assert_array_equal(numpy_model.NumpyModel.from_keras(self._json, self._weights).predict(self.input),
+                           model.predict(self.input))
+
+    def test_unsupported_layer(self):
+        json_path = os.path.join(self.directory, 'model.json')
+        with open(json_path, 'w') as json_file:
+            json.dump({"class_name": "Sequential", "config": [{"class_name": "Conv2D", "config": {}}]}, json_file)
+        self.assertRaises(ValueError, numpy_model.NumpyModel.from_keras, json_path, self._weights)
+
+    def test_identity_layers(self):
+        with open(self._json, 'r') as json_file:
+            model = json.load(json_file)
+        model["config"] = [{"class_name": "InputLayer", "config": {"batch_input_shape": [None, 36]}}] + \
+            model["config"][0:2] + [{"class_name": "Dropout", "config": {"rate": 0.5}}] + model["config"][2:]
+        json_path = os.path.join(self.directory, 'model.json')
+        with open(json_path, 'w') as json_file:
+            json.dump(model, json_file)
+
+        assert_array_equal(numpy_model.NumpyModel.from_keras(self._json, self._weights).predict(self.input),
+                           numpy_model.NumpyModel.from_keras(json_path, self._weights).predict(self.input))
+
+    def test_registry_backend(self):
+        model_registry.register('test_numpy', self._json, self._weights, backend=model_registry.BACKEND_NUMPY)
+        self.assertIsInstance(model_registry.get('test_numpy'), numpy_model.NumpyModel)
+        model_registry.unload('test_numpy')
+
+    def test_registry_wrong_backend(self):
+        self.assertRaises(ValueError, model_registry.register, 'test', self._json, self._weights, True, 'other')
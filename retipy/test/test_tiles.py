@@ -0,0 +1,88 @@
+# Retipy - Retinal Image Processing on Python
+# Copyright (C) 2018  Alejandro Valdes
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""tests for tiles module"""
+
+import multiprocessing
+import os
+from unittest import TestCase
+
+import cv2
+import numpy as np
+from numpy.testing import assert_array_equal
+from scipy import ndimage
+from skimage import io
+from retipy import retina_grayscale, tiles
+
+_image_path = 'retipy/test/resources/images/01_h.jpg'
+
+
+def _tiled_blur(image: np.ndarray):
+    tiles.threads = 4
+    tiles.min_tile_rows = 16
+    return os.getpid(), tiles.apply(cv2.blur, image, 5, (11, 11))
+
+
+class TestTiles(TestCase):
+
+    def setUp(self):
+        self._threads = tiles.threads
+        self._min_tile_rows = tiles.min_tile_rows
+        tiles.threads = 4
+        tiles.min_tile_rows = 16
+        self.image = io.imread(_image_path)[:, :, 1]
+
+    def tearDown(self):
+        tiles.threads = self._threads
+        tiles.min_tile_rows = self._min_tile_rows
+
+    def test_apply_filters(self):
+        assert_array_equal(cv2.medianBlur(self.image, 41), tiles.apply(cv2.medianBlur, self.image, 20, 41))
+        assert_array_equal(cv2.blur(self.image, (11, 11)), tiles.apply(cv2.blur, self.image, 5, (11, 11)))
+        assert_array_equal(cv2.GaussianBlur(self.image, (33, 33), 1.82),
+                           tiles.apply(cv2.GaussianBlur, self.image, 16, (33, 33), 1.82))
+        assert_array_equal(ndimage.grey_opening(self.image, size=(13, 13)),
+                           tiles.apply(ndimage.grey_opening, self.image, tiles.opening_halo(13), size=(13, 13)))
+        assert_array_equal(
+            cv2.adaptiveThreshold(self.image, 255, cv2.ADAPTIVE_THRESH_MEAN_C, cv2.THRESH_BINARY, 13, 2),
+            tiles.apply(cv2.adaptiveThreshold, self.image, 6, 255, cv2.ADAPTIVE_THRESH_MEAN_C, cv2.THRESH_BINARY, 13, 2))
+
+    def test_apply_small_image(self):
+        tiles.min_tile_rows = self.image.shape[0]
+        calls = []
+        tiles.apply(lambda tile: calls.append(tile.shape) or tile, self.image, 1)
+        self.assertEqual([self.image.shape], calls)
+
+    def test_apply_tiles(self):
+        shapes = []
+        result = tiles.apply(lambda tile: shapes.append(tile.shape) or tile, self.image[0:100], 3)
+        assert_array_equal(self.image[0:100], result)
+        self.assertEqual(4, len(shapes))
+        self.assertEqual((28, self.image.shape[1]), shapes[0])
+
+    def test_apply_forked(self):
+        tiles.apply(cv2.blur, self.image, 5, (11, 11))
+        # the forked process can not use the threads of the pool created above
+        with multiprocessing.get_context("fork").Pool(1) as pool:
+            pid, result = pool.apply_async(_tiled_blur, (self.image,)).get(60)
+        self.assertNotEqual(os.getpid(), pid)
+        assert_array_equal(cv2.blur(self.image, (11, 11)), result)
+
+    def test_double_segmentation(self):
+        image = 'retipy/resources/images/img01.png'
+        tiled = retina_grayscale.Retina_grayscale(None, image).double_segmentation()
+        tiles.threads = 1
+        assert_array_equal(retina_grayscale.Retina_grayscale(None, image).double_segmentation(), tiled)
@@ -15,10 +15,16 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 """tests for vessel classification module"""
+import os
+import shutil
+import tempfile
 from unittest import TestCase
 from retipy.retina import Retina
 from retipy import landmarks as l
 from retipy import vessel_classification as vc
+from retipy import evaluation
+from retipy import model_registry
+from retipy import numpy_model
 import numpy as np
 from numpy.testing import assert_array_equal
 import cv2
@@ -51,6 +57,12 @@ class TestVesselClassification(TestCase):
         window = [[5, 8, 1], [5, 4, 1], [3, 7, 2]]
         self.assertEqual(46, vc._local_binary_pattern(window), "LBP wrong calculated, should return 162")
 
+    def test_LBP_image(self):
+        gray = cv2.cvtColor(self.original, cv2.COLOR_BGR2GRAY)
+        lbp = vc._local_binary_pattern_image(gray)
+        for x, y in [[1, 1], [100, 200], [200, 150], [gray.shape[0] - 2, gray.shape[1] - 2]]:
+            self.assertEqual(vc._local_binary_pattern(gray[x - 1:x + 2, y - 1:y + 2]), lbp[x, y], "LBP does not match")
+
     def test_vectors(self):
         self.manual.threshold_image()
         threshold = self.manual.get_uint_image()
@@ -60,7 +72,7 @@ class TestVesselClassification(TestCase):
         lab = cv2.cvtColor(self.original, cv2.COLOR_BGR2LAB)
         L, A, B = cv2.split(lab)
         widths = vc._vessel_widths(skeleton, threshold)
-        iv = vc._vector(widths[0], 6, self.original, L, gray, 0)
+        iv = vc._vector(widths[0], 6, self.original, L, vc._local_binary_pattern_image(gray), 0)
 
         result = np.genfromtxt(self._test_path + "vector_test.csv", delimiter=',')
         assert_array_equal(result, iv, "Feature vector does not match")
@@ -111,16 +123,69 @@ class TestVesselClassification(TestCase):
         assert_array_equal(result, segments[:, 20], "Segmented skeleton image does not match")
         assert_array_equal(result2, predictions[:, 20], "Neural Network predictions does not match")
 
+    def test_loading_model_batch_size(self):
+        features, segments, thr, predictions = vc._loading_model(self.original, self.manual.np_image, self.av, 38)
+        features2, segments2, thr2, predictions2 = vc._loading_model(
+            self.original, self.manual.np_image, self.av, 38, batch_size=7)
+
+        np.testing.assert_allclose(predictions, predictions2, 1e-6)
+
+    def test_mask_optic_disc(self):
+        gray = cv2.cvtColor(self.original, cv2.COLOR_BGR2GRAY)
+        (minVal, maxVal, minLoc, maxLoc) = cv2.minMaxLoc(gray)
+        thr, segments = vc._mask_optic_disc(l.preprocessing(self.manual.np_image, 0), maxLoc)
+
+        self.manual.threshold_image()
+        threshold = self.manual.get_uint_image()
+        cv2.circle(threshold, maxLoc, 60, 0, -1)
+        self.manual.skeletonization()
+        skeleton = self.manual.get_uint_image()
+        cv2.circle(skeleton, maxLoc, 60, 0, -1)
+        landmarks, segmented = l.potential_landmarks(skeleton, 3)
+
+        assert_array_equal(threshold, thr, "Thresholded image does not match")
+        assert_array_equal(segmented, segments, "Segmented skeleton image does not match")
+
     def test_validating_model(self):
         features, segments, thr, predictions = vc._loading_model(self.original, self.manual.np_image, self.av, 38)
         acc, rgb, network, original = vc._validating_model(features, segments, self.original, predictions, 38, 1)
         self.assertEqual(76.18243243243244, acc,  "Wrong validation, should return 81.1214953271028")
 
+    def test_threshold_sweep(self):
+        features, segments, thr, predictions = vc._loading_model(self.original, self.manual.np_image, self.av, 38)
+        sweep = vc.threshold_sweep(features, predictions, 38)
+
+        self.assertEqual(1000, sweep["accuracy"].shape[0])
+        self.assertEqual(76.18243243243244, sweep["accuracy"].max(), "Wrong maximum accuracy")
+        assert_array_equal(
+            features.shape[0],
+            sweep["true_positive"] + sweep["true_negative"] + sweep["false_positive"] + sweep["false_negative"])
+
     def test_validating_model_without_av(self):
         features, segments, thr, predictions = vc._loading_model(self.original, self.manual.np_image, self.av, 38)
         acc, rgb, network, original = vc._validating_model(features, segments, self.original, predictions, 38, 0)
         self.assertEqual(-1, acc,  "Wrong validation, should return -1")
 
+    def test_render_labels(self):
+        labels = np.array([[0, 1], [2, 3]], dtype=np.uint8)
+        image = np.full((2, 2, 3), 7, dtype=np.uint8)
+
+        assert_array_equal(
+            [[[0, 0, 0], [255, 0, 0]], [[0, 0, 255], [255, 255, 255]]], vc.render_labels(labels))
+        assert_array_equal(
+            [[[7, 7, 7], [255, 0, 0]], [[0, 0, 255], [7, 7, 7]]], vc.render_labels(labels, image))
+        self.assertEqual(np.uint8, vc.render_labels(labels).dtype)
+
+    def test_prediction_labels(self):
+        features, segments, thr, predictions = vc._loading_model(self.original, self.manual.np_image, self.av, 38)
+        acc, rgb, network, original = vc._validating_model(features, segments, self.original, predictions, 38, 0)
+        labels = vc._prediction_labels(features, segments, predictions, 0.8)
+
+        self.assertEqual(np.uint8, labels.dtype)
+        assert_array_equal(network, np.where(labels == vc.SKELETON, 0, labels))
+        assert_array_equal(original, vc.render_labels(labels, self.original))
+        assert_array_equal(segments > 0, labels > 0)
+
     def test_homogenize(self):
         features, segments, thr, predictions = vc._loading_model(self.original, self.manual.np_image, self.av, 38)
         acc, rgb, network, original = vc._validating_model(features, segments, self.original, predictions, 38, 1)
@@ -164,6 +229,44 @@ class TestVesselClassification(TestCase):
         result = np.genfromtxt(self._test_path + "normalize_indexes_test.csv", delimiter=',')
         assert_array_equal(result, normal, "Width and color do not match")
 
+    def test_label_index(self):
+        features, segments, thr, predictions = vc._loading_model(self.original, self.manual.np_image, self.av, 38)
+        connected_components = cv2.connectedComponentsWithStats(segments.astype(np.uint8), 4, cv2.CV_32S)
+        label_index = vc._LabelIndex(connected_components)
+        pixels = label_index.pixels(7)
+        x, y, width, height = label_index.bounding_box(7)
+
+        assert_array_equal(np.column_stack(np.where(connected_components[1] == 7)), pixels)
+        self.assertEqual(pixels[:, 1].min(), x)
+        self.assertEqual(pixels[:, 0].min(), y)
+        self.assertEqual(pixels[:, 1].max() - x + 1, width)
+        self.assertEqual(pixels[:, 0].max() - y + 1, height)
+        self.assertIs(connected_components[1], vc._labels(label_index))
+        self.assertIs(connected_components[1], vc._labels(connected_components))
+
+    def test_segment_samples(self):
+        features, segments, thr, predictions = vc._loading_model(self.original, self.manual.np_image, self.av, 38)
+        connected_components = cv2.connectedComponentsWithStats(segments.astype(np.uint8), 4, cv2.CV_32S)
+        samples = vc._segment_samples(connected_components, 3)
+        labels = connected_components[1]
+        counts = np.bincount(labels[samples == 255], minlength=connected_components[0])
+        sizes = np.bincount(labels.ravel(), minlength=connected_components[0])
+
+        self.assertTrue(np.all(segments[samples == 255] == 255))
+        assert_array_equal(np.minimum(sizes[1:], 3), counts[1:])
+        self.assertRaises(ValueError, vc._segment_samples, connected_components, 0)
+
+    def test_segment_vote(self):
+        labels = np.array([[1, 1, 1, 0, 2, 2], [0, 0, 0, 0, 0, 0], [3, 3, 0, 4, 4, 4]], dtype=np.int32)
+        network = np.array([[1, 0, 2, 0, 2, 0], [0, 0, 0, 0, 0, 0], [1, 2, 0, 0, 0, 0]])
+        result = vc._segment_vote((5, labels, None, None), network)
+
+        assert_array_equal([[1, 0, 2, 0, 2, 2], [0, 0, 0, 0, 0, 0], [1, 2, 0, 0, 0, 0]], result)
+
+        majority, classified = vc._majority(labels, network)
+        assert_array_equal([0, 0, 2, 0, 0], majority)
+        assert_array_equal([0, 2, 1, 2, 0], classified)
+
     def test_coloring(self):
         features, segments, thr, predictions = vc._loading_model(self.original, self.manual.np_image, self.av, 38)
         connected_components = cv2.connectedComponentsWithStats(segments.astype(np.uint8), 4, cv2.CV_32S)
@@ -186,6 +289,18 @@ class TestVesselClassification(TestCase):
         result = np.genfromtxt(self._test_path + "postprocessing_test.csv", delimiter=',')
         assert_array_equal(result, post_img[:, 20], "Post image does not match")
 
+    def test_postprocessing_labels(self):
+        bifurcations, crossings = l.classification(self.manual.np_image, 0)
+        features, segments, thr, predictions = vc._loading_model(self.original, self.manual.np_image, None, 38)
+        connected_components = cv2.connectedComponentsWithStats(segments.astype(np.uint8), 4, cv2.CV_32S)
+        labels = vc._prediction_labels(features, segments, predictions, 0.8)
+        # half of the segments are left unclassified
+        labels[(connected_components[1] % 2 == 0) & (segments == 255)] = vc.SKELETON
+        post_labels = vc._postprocessing(connected_components, thr, bifurcations, labels)
+        post_img = vc._postprocessing(connected_components, thr, bifurcations, vc.render_labels(labels))
+
+        assert_array_equal(post_img, vc.render_labels(post_labels), "Label map and image postprocessing differ")
+
     def test_accuracy(self):
         bifurcations, crossings = l.classification(self.manual.np_image, 0)
         features, segments, thr, predictions = vc._loading_model(self.original, self.manual.np_image, self.av, 38)
@@ -198,8 +313,63 @@ class TestVesselClassification(TestCase):
 
         assert_array_equal([0.8447412353923205, 0.7686274509803922, 0.9011627906976745], acc, "Accuracy does not match")
 
+    def test_register_model(self):
+        directory = tempfile.mkdtemp()
+        try:
+            npz_path = os.path.join(directory, 'modelVA.npz')
+            numpy_model.convert(vc._base_directory_model + 'modelVA.json', vc._base_directory_model + 'modelVA.h5',
+                                npz_path)
+            os.environ["RETIPY_VA_MODEL"] = npz_path
+            vc._register_model()
+            model = model_registry.get(vc._model_name)
+        finally:
+            del os.environ["RETIPY_VA_MODEL"]
+            vc._register_model()
+            shutil.rmtree(directory)
+
+        self.assertIsInstance(model, numpy_model.NumpyModel)
+
     def test_classification(self):
         post_img = vc.classification(self.original, self.manual.np_image)
 
         result = np.genfromtxt(self._test_path + "classification_test.csv", delimiter=',')
         assert_array_equal(result, post_img[:, 20], "Classificated image does not match")
+
+    def test_classification_segments(self):
+        features, segments, thr, predictions = vc._loading_model(
+            self.original, self.manual.np_image, None, 38, samples_per_segment=3)
+        full_features = vc._loading_model(self.original, self.manual.np_image, None, 38)[0]
+        post_img = vc.classification(self.original, self.manual.np_image, samples_per_segment=3)
+        result = evaluation.evaluate_av(post_img, self.av, segments == 255)
+
+        self.assertLess(features.shape[0] * 5, full_features.shape[0])
+        self.assertGreater(result["accuracy"], 0.85)
+
+    def test_feature_vectors_directory(self):
+        directory = tempfile.mkdtemp() + '/'
+        try:
+            for folder in ['original', 'manual', 'av']:
+                os.mkdir(directory + folder)
+            for name in ['a', 'b']:
+                shutil.copy(self._resources + 'original.tif', directory + 'original/' + name + '.tif')
+                shutil.copy(self._resources + 'manual.png', directory + 'manual/' + name + '.png')
+                shutil.copy(self._resources + 'av.png', directory + 'av/' + name + '.png')
+            output = directory + 'features.h5'
+            vectors = vc._feature_vectors(directory, output, 2)
+            name, image_vectors = vc._image_features((directory, 'a', 6))
+
+            # a second build only reads the stored vectors
+            os.remove(directory + 'original/a.tif')
+            resumed = vc._feature_vectors(directory, output, 2, resume=True)
+            self.assertRaises(ValueError, vc._feature_vectors, directory, output, 2, True, 5)
+            with h5py.File(output, 'r') as h5f:
+                images = list(h5f['images'][:])
+                image = h5f['image'][:]
+        finally:
+            shutil.rmtree(directory)
+
+        self.assertEqual(2 * image_vectors.shape[0], vectors.shape[0])
+        assert_array_equal(image_vectors, vectors[0:image_vectors.shape[0]], "Vectors does not match")
+        assert_array_equal(vectors, resumed, "Resumed vectors does not match")
+        self.assertEqual(2, len(images))
+        assert_array_equal(np.repeat([0, 1], image_vectors.shape[0]), image)
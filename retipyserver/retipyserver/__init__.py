@@ -1,3 +1,4 @@
+import os
 from flask import Flask
 app = Flask(__name__)
 base_url = "/retipy/"
@@ -7,3 +8,9 @@ from . import endpoint_tortuosity
 from . import endpoint_segmentation
 from . import endpoint_landmarks
 from . import endpoint_vessel_classification
+from . import workers
+
+# with the worker pools the models are used, and loaded, in the worker processes
+if os.environ.get("RETIPY_PRELOAD_MODELS") and not workers.enabled:  # pragma: no cover
+    from retipy import model_registry
+    model_registry.preload()
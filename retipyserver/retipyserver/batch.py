@@ -0,0 +1,137 @@
+# Retipy - Retinal Image Processing on Python
+# Copyright (C) 2018  Alejandro Valdes
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Module with the batch variants of the endpoints, that process many images in one request.
+
+The items of a batch are sent as:
+- a json body with an "images" list, each item is an object like the json body of the single image endpoint, with an
+  optional "id" to identify it in the results
+- a multipart/form-data body with several files for each image name of the endpoint, the items are formed by the
+  files in the same position and identified by the name of their first file. The form fields are the options of
+  every item
+
+The items are processed in parallel in the worker pool of the endpoint and each result is streamed back as a line of
+json (application/x-ndjson) as soon as it is ready, so the results are not in the order of the items. Each line has
+the "index" of its item, its "id", "success" and either the "result" of the single image endpoint or an "error". An
+item that fails does not affect the rest of the batch.
+"""
+
+import base64
+import flask
+from . import cache
+from . import workers
+
+NDJSON = "application/x-ndjson"
+
+
+def _error(error: Exception):
+    return "{}: {}".format(type(error).__name__, error)
+
+
+def read_items(names: list):
+    """
+    Reads the items of a batch request
+    :param names: the names of the images that the endpoint receives
+    :return: a list with an (id, images, options, error) tuple for each item, where images is a dictionary with the
+             bytes of each image by name and error is the reason why the item could not be read, or None. Returns
+             None if the request is not a batch
+    """
+    request = flask.request
+    body = request.get_json(silent=True)
+    if body is not None:
+        if not isinstance(body, dict) or not isinstance(body.get("images"), list):
+            return None
+        items = []
+        for index, item in enumerate(body["images"]):
+            item_id = item.get("id", index) if isinstance(item, dict) else index
+            try:
+                items.append((item_id, {name: base64.b64decode(item[name]) for name in names}, item, None))
+            except Exception as error:
+                items.append((item_id, None, None, _error(error)))
+        return items
+    if request.mimetype == "multipart/form-data":
+        files = [request.files.getlist(name) for name in names]
+        if not files[0] or any(len(files_of_name) != len(files[0]) for files_of_name in files):
+            return None
+        return [(item[0].filename, {name: file.read() for name, file in zip(names, item)}, request.form, None)
+                for item in zip(*files)]
+    return None
+
+
+def response(endpoint: str, endpoint_class: str, function, names: list, options=None, image_key: str = None):
+    """
+    Processes a batch request
+    :param endpoint: the name of the single image endpoint, it identifies its results in the cache
+    :param endpoint_class: the worker pool of the endpoint, one of workers.ENDPOINT_CLASSES
+    :param function: the picklable function of the single image endpoint, it is called with the bytes of each image
+                     in the order of names and with the options as keyword arguments
+    :param names: the names of the images that the endpoint receives
+    :param options: optional function that returns the keyword arguments of function for the options of an item
+    :param image_key: the key of the png image in the result, if the endpoint returns an image
+    :return: a streamed json lines response, or a json response with success false if the request is not a batch
+    """
+    items = read_items(names)
+    if items is None:
+        return flask.jsonify({"success": False})
+
+    lines = []
+    keys = {}
+    calls = []
+    for index, (item_id, images, item_options, error) in enumerate(items):
+        if error is not None:
+            lines.append(_line(index, item_id, error=error))
+            continue
+        try:
+            kwargs = options(item_options) if options is not None else {}
+        except Exception as error:
+            lines.append(_line(index, item_id, error=_error(error)))
+            continue
+        key = cache.results.key(endpoint, images, kwargs)
+        result = cache.results.get(key)
+        if result is not None:
+            lines.append(_line(index, item_id, result, image_key))
+        else:
+            keys[len(calls)] = (index, item_id, key)
+            calls.append(([images[name] for name in names], kwargs))
+
+    # it raises QueueFull before anything is streamed when the pool is full
+    results = workers.run_many(endpoint_class, function, calls) if calls else iter([])
+
+    def _stream():
+        for line in lines:
+            yield line
+        for call, result, error in results:
+            index, item_id, key = keys[call]
+            if error is not None:
+                yield _line(index, item_id, error=_error(error))
+            else:
+                cache.results.put(key, result)
+                yield _line(index, item_id, result, image_key)
+
+    return flask.Response(flask.stream_with_context(_stream()), mimetype=NDJSON)
+
+
+def _line(index: int, item_id, result: dict = None, image_key: str = None, error: str = None):
+    line = {"index": index, "id": item_id, "success": error is None}
+    if error is not None:
+        line["error"] = error
+    else:
+        if image_key is not None:
+            result = dict(result)
+            result[image_key] = base64.b64encode(result[image_key]).decode("utf-8")
+        line["result"] = result
+    return flask.json.dumps(line) + "\n"
@@ -0,0 +1,254 @@
+# Retipy - Retinal Image Processing on Python
+# Copyright (C) 2018  Alejandro Valdes
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Module with a cache of the endpoint results, so an image that was already processed is not processed again. Results
+are identified by a hash of the endpoint, its options, the bytes of its images, the retipy version and the weights
+files of the models, so a new release or new weights do not return stale results.
+
+The results are kept in memory up to a number of bytes, the least recently used ones are evicted first. They can also
+be kept in a directory shared by every server process, up to another number of bytes, where the least recently used
+files are removed first. The memory budget is taken from the RETIPY_CACHE_BYTES environment variable (0 disables the
+memory tier), the directory from RETIPY_CACHE_DIR (by default there is no directory) and its budget from
+RETIPY_CACHE_DIR_BYTES.
+
+The results are stored as json, the bytes values of a result (the png images) are stored in base64.
+"""
+
+import base64
+import hashlib
+import json
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+import retipy
+from retipy import model_registry
+
+default_max_bytes = 64 * 1024 * 1024
+default_max_directory_bytes = 1024 * 1024 * 1024
+
+_extension = ".json"
+
+# the directory is also scanned after this number of writes, to count the files written by other processes
+prune_interval = 64
+
+
+def _encode(result: dict):
+    values = {name: value for name, value in result.items() if not isinstance(value, bytes)}
+    binary = {name: base64.b64encode(value).decode("ascii")
+              for name, value in result.items() if isinstance(value, bytes)}
+    return json.dumps({"values": values, "binary": binary}).encode("utf-8")
+
+
+def _decode(data: bytes):
+    stored = json.loads(data.decode("utf-8"))
+    result = stored["values"]
+    result.update({name: base64.b64decode(value) for name, value in stored["binary"].items()})
+    return result
+
+
+def _version():
+    return json.dumps([retipy.__version__, model_registry.versions()], sort_keys=True)
+
+
+class ResultCache(object):
+    """
+    A cache of endpoint results with a least recently used memory tier and an optional directory tier.
+
+    :param max_bytes: the maximum size of the results kept in memory
+    :param directory: optional directory where the results are also kept
+    :param max_directory_bytes: the maximum size of the files of the directory
+    """
+    def __init__(self, max_bytes: int, directory: str = None, max_directory_bytes: int = default_max_directory_bytes):
+        if max_bytes < 0 or max_directory_bytes < 0:
+            raise ValueError("The cache size can not be negative")
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self.max_directory_bytes = max_directory_bytes
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._bytes = 0
+        # estimate of the size of the directory and writes since it was last scanned, None before the first scan
+        self._directory_bytes = None
+        self._writes = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(endpoint: str, images: dict, options: dict = None):
+        """
+        Calculates the key of a result
+        :param endpoint: the name of the endpoint
+        :param images: a dictionary with the bytes of each image by name
+        :param options: a json serializable dictionary with the options that change the result
+        :return: an hexadecimal sha256 hash
+        """
+        digest = hashlib.sha256()
+        digest.update(_version().encode("utf-8"))
+        digest.update(json.dumps([endpoint, options or {}], sort_keys=True).encode("utf-8"))
+        for name in sorted(images):
+            digest.update(name.encode("utf-8"))
+            digest.update(hashlib.sha256(images[name]).digest())
+        return digest.hexdigest()
+
+    def _path(self, key: str):
+        return os.path.join(self.directory, key[:2], key + _extension)
+
+    def _remember(self, key: str, data: bytes):
+        # called with the lock held
+        if key in self._entries:
+            self._bytes -= len(self._entries.pop(key))
+        if len(data) > self.max_bytes:
+            return
+        self._entries[key] = data
+        self._bytes += len(data)
+        while self._bytes > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self._bytes -= len(evicted)
+
+    def get(self, key: str):
+        """
+        Looks for a result
+        :param key: the key of the result, see key
+        :return: the result, or None if it is not in the cache
+        """
+        with self._lock:
+            data = self._entries.get(key)
+            if data is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+        if data is None and self.directory is not None:
+            try:
+                with open(self._path(key), "rb") as entry:
+                    data = entry.read()
+                # the modification time is the last use of the file, the oldest ones are removed first
+                os.utime(self._path(key))
+            except OSError:
+                pass
+            with self._lock:
+                if data is not None:
+                    self._remember(key, data)
+                    self.hits += 1
+                    self.disk_hits += 1
+        if data is None:
+            with self._lock:
+                self.misses += 1
+            return None
+        return _decode(data)
+
+    def put(self, key: str, result: dict):
+        """
+        Stores a result
+        :param key: the key of the result, see key
+        :param result: a dictionary with json serializable or bytes values
+        """
+        data = _encode(result)
+        with self._lock:
+            self._remember(key, data)
+        if self.directory is not None and len(data) <= self.max_directory_bytes:
+            path = self._path(key)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # other processes can read the directory at the same time, so the file is written under another name
+            handle, temporary_path = tempfile.mkstemp(suffix=".tmp", dir=os.path.dirname(path))
+            with os.fdopen(handle, "wb") as entry:
+                entry.write(data)
+            os.replace(temporary_path, path)
+            with self._lock:
+                self._writes += 1
+                scan = self._directory_bytes is None or self._writes >= prune_interval
+                if not scan:
+                    self._directory_bytes += len(data)
+                    scan = self._directory_bytes > self.max_directory_bytes
+                if scan:
+                    self._writes = 0
+            if scan:
+                total = self._prune()
+                with self._lock:
+                    self._directory_bytes = total
+
+    def _prune(self):
+        # removes the least recently used files until the directory fits in its budget, returns its new size
+        files = []
+        for folder in os.scandir(self.directory):
+            if folder.is_dir():
+                for entry in os.scandir(folder.path):
+                    if entry.name.endswith(_extension):
+                        try:
+                            stat = entry.stat()
+                        except OSError:
+                            continue
+                        files.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.max_directory_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                # another process removed it already
+                pass
+            total -= size
+        return total
+
+    def cached(self, endpoint: str, images: dict, options: dict, compute):
+        """
+        Returns the stored result of an endpoint, or computes and stores it
+        :param endpoint: the name of the endpoint
+        :param images: a dictionary with the bytes of each image by name
+        :param options: a json serializable dictionary with the options that change the result
+        :param compute: a function without arguments that calculates the result
+        :return: the result
+        """
+        key = self.key(endpoint, images, options)
+        result = self.get(key)
+        if result is None:
+            result = compute()
+            self.put(key, result)
+        return result
+
+    def stats(self):
+        """Returns the hit and miss counts of this process and the size of the memory tier"""
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "directory": self.directory,
+                "max_directory_bytes": self.max_directory_bytes}
+
+    def clear(self):
+        """Empties the memory tier and resets the counts, the directory is not modified"""
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+            self.hits = 0
+            self.disk_hits = 0
+            self.misses = 0
+
+
+results = ResultCache(
+    int(os.environ.get("RETIPY_CACHE_BYTES", default_max_bytes)), os.environ.get("RETIPY_CACHE_DIR") or None,
+    int(os.environ.get("RETIPY_CACHE_DIR_BYTES", default_max_directory_bytes)))
+
+
+def cached(endpoint: str, images: dict, options: dict, compute):
+    """Returns the result of an endpoint from the results cache, see ResultCache.cached"""
+    return results.cached(endpoint, images, options, compute)
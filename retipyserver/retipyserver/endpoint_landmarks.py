@@ -19,7 +19,6 @@ Module with all REST endpoints to identify and classify landmarks given a graysc
 All operations are implemented as POST
 """
 
-import base64
 import flask
 import io
 import numpy as np
@@ -27,19 +26,33 @@ from PIL import Image
 from retipy import landmarks
 from . import app
 from . import base_url
+from . import batch
+from . import cache
+from . import payload
+from . import workers
 
 landmarks_url = base_url + "landmarks/"
 
 
+def _classification(image: bytes):
+    image = Image.open(io.BytesIO(image)).convert('L')
+    bifurcations_data, crossings_data = landmarks.classification(np.array(image), 20)
+    return {"bifurcations": bifurcations_data, "crossings": crossings_data}
+
+
 @app.route(landmarks_url + "classification", methods=["POST"])
 def post_landmarks_classification():
     data = {"success": False}
 
     if flask.request.method == "POST":
-        json = flask.request.get_json(silent=True)
-        if json is not None:  # pragma: no cover
-            image = base64.b64decode(json["image"])
-            image = Image.open(io.BytesIO(image)).convert('L')
-            bifurcations_data, crossings_data = landmarks.classification(np.array(image), 20)
-            data = {"bifurcations": bifurcations_data, "crossings": crossings_data}
+        images, _ = payload.read_request(["image"])
+        if images is not None:  # pragma: no cover
+            data = cache.cached(
+                "landmarks/classification", images, {},
+                lambda: workers.run(workers.MEASURES, _classification, images["image"]))
     return flask.jsonify(data)
+
+
+@app.route(landmarks_url + "classification/batch", methods=["POST"])
+def post_landmarks_classification_batch():
+    return batch.response("landmarks/classification", workers.MEASURES, _classification, ["image"])
@@ -21,6 +21,8 @@ Module with endpoints related to server functionality and status.
 import flask
 from . import app
 from . import base_url
+from . import cache
+from . import workers
 
 
 @app.route(base_url + "status", methods=["GET"])
@@ -31,3 +33,25 @@ def retipy_server_status():
     :return: HTTP status 200 if the REST server is working.
     """
     return flask.make_response('', 200)
+
+
+@app.route(base_url + "cache", methods=["GET"])
+def retipy_server_cache():
+    """
+    Reports the hit and miss counts of the results cache in this server process.
+    :return: a json with the cache statistics
+    """
+    return flask.jsonify(cache.results.stats())
+
+
+@app.errorhandler(workers.QueueFull)
+def retipy_server_busy(error):
+    """
+    Rejects the requests that do not fit in the worker pool of their endpoint class, so the client can retry later
+    instead of waiting behind the running requests.
+    :return: HTTP status 503 with a Retry-After header
+    """
+    response = flask.jsonify({"success": False, "error": str(error)})
+    response.status_code = 503
+    response.headers["Retry-After"] = "1"
+    return response
@@ -19,7 +19,6 @@ Module with all REST endpoints to calculate tortuosity measures given a grayscal
 All operations are implemented as POST
 """
 
-import base64
 import io
 import flask
 import numpy as np
@@ -28,18 +27,42 @@ import cv2
 from retipy import retina_grayscale
 from . import app
 from . import base_url
+from . import batch
+from . import cache
+from . import payload
+from . import workers
 
 segmentation_url = base_url + "segmentation/"
 
+
+def _segmentation(image: bytes, fast: bool):
+    image = Image.open(io.BytesIO(image))
+    retina = retina_grayscale.Retina_grayscale(np.array(image), None)
+    # screening clients can ask for the faster reduced resolution segmentation
+    if fast:
+        segmentation = retina.fast_segmentation()
+    else:
+        segmentation = retina.double_segmentation()
+    return {"segmentation": payload.png(segmentation)}
+
+
 @app.route(segmentation_url + "double_segmentation", methods=["POST"])
 def post_segmentation_double_segmentation():
     data = {"success": False} # pragma: no cover
 
     if flask.request.method == "POST": # pragma: no cover
-        json = flask.request.get_json(silent=True)
-        if json is not None:  # pragma: no cover
-            image = base64.b64decode(json["image"])
-            image = Image.open(io.BytesIO(image))
-            retina = retina_grayscale.Retina_grayscale(np.array(image), None)
-            data = {"segmentation": retina.double_segmentation()}
+        images, options = payload.read_request(["image"])
+        if images is not None:  # pragma: no cover
+            fast = payload.flag(options, "fast")
+            data = cache.cached(
+                "segmentation/double_segmentation", images, {"fast": fast},
+                lambda: workers.run(workers.SEGMENTATION, _segmentation, images["image"], fast))
+            return payload.image_response(data, "segmentation")
     return flask.jsonify(data) # pragma: no cover
+
+
+@app.route(segmentation_url + "double_segmentation/batch", methods=["POST"])
+def post_segmentation_double_segmentation_batch():
+    return batch.response(
+        "segmentation/double_segmentation", workers.SEGMENTATION, _segmentation, ["image"],
+        lambda options: {"fast": payload.flag(options, "fast")}, "segmentation")
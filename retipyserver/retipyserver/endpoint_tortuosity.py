@@ -19,7 +19,6 @@ Module with all REST endpoints to calculate tortuosity measures given a grayscal
 All operations are implemented as POST
 """
 
-import base64
 import flask
 import io
 import numpy as np
@@ -27,20 +26,33 @@ from PIL import Image
 from retipy import tortuosity
 from . import app
 from . import base_url
+from . import batch
+from . import cache
+from . import payload
+from . import workers
 
 tortuosity_url = base_url + "tortuosity/"
 
 
+def _density(image: bytes):
+    image = Image.open(io.BytesIO(image)).convert('L')
+    return tortuosity.density(np.array(image))
+
+
+def _fractal(image: bytes):
+    image = Image.open(io.BytesIO(image)).convert('L')
+    return tortuosity.fractal(np.array(image))
+
+
 @app.route(tortuosity_url + "density", methods=["POST"])
 def post_tortuosity_density():
     data = {"success": False}
 
     if flask.request.method == "POST":
-        json = flask.request.get_json(silent=True)
-        if json is not None:  # pragma: no cover
-            image = base64.b64decode(json["image"])
-            image = Image.open(io.BytesIO(image)).convert('L')
-            data = tortuosity.density(np.array(image))
+        images, _ = payload.read_request(["image"])
+        if images is not None:  # pragma: no cover
+            data = cache.cached(
+                "tortuosity/density", images, {}, lambda: workers.run(workers.MEASURES, _density, images["image"]))
     return flask.jsonify(data)
 
 
@@ -49,9 +61,18 @@ def post_tortuosity_fractal():
     data = {"success": False}
 
     if flask.request.method == "POST":
-        json = flask.request.get_json(silent=True)
-        if json is not None:  # pragma: no cover
-            image = base64.b64decode(json["image"])
-            image = Image.open(io.BytesIO(image)).convert('L')
-            data = tortuosity.fractal(np.array(image))
+        images, _ = payload.read_request(["image"])
+        if images is not None:  # pragma: no cover
+            data = cache.cached(
+                "tortuosity/fractal", images, {}, lambda: workers.run(workers.MEASURES, _fractal, images["image"]))
     return flask.jsonify(data)
+
+
+@app.route(tortuosity_url + "density/batch", methods=["POST"])
+def post_tortuosity_density_batch():
+    return batch.response("tortuosity/density", workers.MEASURES, _density, ["image"])
+
+
+@app.route(tortuosity_url + "fractal/batch", methods=["POST"])
+def post_tortuosity_fractal_batch():
+    return batch.response("tortuosity/fractal", workers.MEASURES, _fractal, ["image"])
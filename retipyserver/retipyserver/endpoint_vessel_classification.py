@@ -20,33 +20,47 @@ and a/v image
 All operations are implemented as POST
 """
 
-import base64
 import flask
 import io
 import numpy as np
 from PIL import Image
 from retipy import vessel_classification
-from retipy.retina import Retina
 from . import app
 from . import base_url
+from . import batch
+from . import cache
+from . import payload
+from . import workers
 
 vessel_classification_url = base_url + "vessel_classification/"
 
 
+def _classification(original: bytes, segmented: bytes):
+    segmented = Image.open(io.BytesIO(segmented)).convert('L')
+    original = Image.open(io.BytesIO(original)).convert('RGB')
+    return {
+        "classification": payload.png(
+            vessel_classification.classification(
+                np.array(original), np.array(segmented)))}
+
+
 @app.route(vessel_classification_url + "classification", methods=["POST"])
 def post_vessel_classification():
     data = {"success": False}
 
     if flask.request.method == "POST":
-        json = flask.request.get_json(silent=True)
-        if json is not None:  # pragma: no cover
-            segmented = base64.b64decode(json["segmented_image"])
-            segmented = Image.open(io.BytesIO(segmented)).convert('L')
-            original = base64.b64decode(json["original_image"])
-            original = Image.open(io.BytesIO(original)).convert('RGB')
-            data = {
-                "classification": Retina.get_base64_image(
-                    vessel_classification.classification(
-                        np.array(original), np.array(segmented)),
-                    False)}
+        images, _ = payload.read_request(["original_image", "segmented_image"])
+        if images is not None:  # pragma: no cover
+            data = cache.cached(
+                "vessel_classification/classification", images, {},
+                lambda: workers.run(
+                    workers.CLASSIFICATION, _classification, images["original_image"], images["segmented_image"]))
+            return payload.image_response(data, "classification")
     return flask.jsonify(data)
+
+
+@app.route(vessel_classification_url + "classification/batch", methods=["POST"])
+def post_vessel_classification_batch():
+    return batch.response(
+        "vessel_classification/classification", workers.CLASSIFICATION, _classification,
+        ["original_image", "segmented_image"], image_key="classification")
@@ -0,0 +1,88 @@
+# Retipy - Retinal Image Processing on Python
+# Copyright (C) 2018  Alejandro Valdes
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Module to read the images sent to the endpoints and to write the images they return.
+
+The images can be sent in three ways:
+- a json body with each image encoded in base64, the other json fields are the options of the request
+- a multipart/form-data body with each image as a file, the other form fields are the options
+- the raw image as the body, with an image/* or application/octet-stream content type. It is only possible for the
+  endpoints that receive a single image, the options are taken from the query string
+
+An image result is returned as raw png bytes when the request prefers image/png in its Accept header, otherwise it is
+returned in base64 inside the json response.
+"""
+
+import base64
+from io import BytesIO
+import flask
+import numpy as np
+from PIL import Image
+
+RAW_TYPES = ["application/octet-stream"]
+
+JSON = "application/json"
+PNG = "image/png"
+
+_true_values = [True, "true", "True", "1", "yes"]
+
+
+def read_request(names: list):
+    """
+    Reads the images of the current request
+    :param names: the names of the images that the endpoint receives
+    :return: a dictionary with the bytes of each image by name and a dictionary with the options of the request, or
+             (None, None) if the request does not have the images
+    """
+    request = flask.request
+    json = request.get_json(silent=True)
+    if json is not None:
+        return {name: base64.b64decode(json[name]) for name in names}, json
+    if request.mimetype == "multipart/form-data":
+        if all(name in request.files for name in names):
+            return {name: request.files[name].read() for name in names}, request.form
+    elif len(names) == 1 and (request.mimetype.startswith("image/") or request.mimetype in RAW_TYPES):
+        body = request.get_data()
+        if body:
+            return {names[0]: body}, request.args
+    return None, None
+
+
+def flag(options, name: str):
+    """Returns True if the given option of the request is set to a true value"""
+    return options.get(name, False) in _true_values
+
+
+def png(image: np.ndarray):
+    """Encodes an image as png"""
+    buffer = BytesIO()
+    Image.fromarray(image).save(buffer, format="png")
+    return buffer.getvalue()
+
+
+def image_response(data: dict, key: str):
+    """
+    Creates the response of an endpoint that returns an image
+    :param data: the result of the endpoint
+    :param key: the key of the png image in data
+    :return: the raw png if the client prefers it, otherwise the json data with the image encoded in base64
+    """
+    if flask.request.accept_mimetypes.best_match([JSON, PNG]) == PNG:
+        return flask.Response(data[key], mimetype=PNG)
+    data = dict(data)
+    data[key] = base64.b64encode(data[key]).decode("utf-8")
+    return flask.jsonify(data)
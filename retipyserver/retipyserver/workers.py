@@ -0,0 +1,247 @@
+# Retipy - Retinal Image Processing on Python
+# Copyright (C) 2018  Alejandro Valdes
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Module that runs the cpu bound work of the endpoints in bounded pools of processes, one for each class of endpoint,
+so a slow request only delays the requests of its own class. The http threads only wait for the results.
+
+Each pool accepts as many requests as it has workers plus its queue depth. When it is full, new requests are rejected
+at once with QueueFull, that the server answers with a 503, instead of waiting behind the running ones.
+
+The pools are used when the RETIPY_WORKER_POOL environment variable is set, otherwise the work is run in the request
+thread. The size of each pool is taken from RETIPY_<CLASS>_WORKERS and RETIPY_<CLASS>_QUEUE_DEPTH, where <CLASS> is
+the upper case name of the endpoint class.
+
+The worker processes are started with spawn, tensorflow does not work in a process forked after it was initialised.
+When RETIPY_PRELOAD_MODELS is set, each worker loads the models of its endpoint class when it starts. Unless
+RETIPY_THREADS is set, the cpus are shared between the workers of a pool to filter the tiles of an image.
+"""
+
+import multiprocessing
+import os
+import threading
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+
+SEGMENTATION = "segmentation"
+CLASSIFICATION = "classification"
+MEASURES = "measures"
+
+ENDPOINT_CLASSES = [SEGMENTATION, CLASSIFICATION, MEASURES]
+
+# the models registered in retipy.model_registry that each endpoint class uses
+ENDPOINT_MODELS = {SEGMENTATION: [], CLASSIFICATION: ["modelVA"], MEASURES: []}
+
+enabled = bool(os.environ.get("RETIPY_WORKER_POOL"))
+
+default_workers = 1
+default_queue_depth = 4
+
+
+def _init_worker(models: list, threads: int):
+    from retipy import tiles
+    # the workers of a pool run at the same time, each one tiles its images with its share of the cpus
+    if "RETIPY_THREADS" not in os.environ:
+        tiles.threads = threads
+    if os.environ.get("RETIPY_PRELOAD_MODELS") and models:  # pragma: no cover
+        from retipy import model_registry
+        model_registry.preload(models)
+
+
+class QueueFull(Exception):
+    """Raised when a pool already has as many requests as its workers and its queue can hold"""
+
+
+class WorkerPool(object):
+    """
+    A pool of processes that holds a bounded number of requests.
+
+    :param workers: number of worker processes
+    :param queue_depth: number of requests that can wait for a free worker
+    :param models: the names of the models that the workers load when they start, if RETIPY_PRELOAD_MODELS is set
+    """
+    def __init__(self, workers: int, queue_depth: int, models: list = None):
+        if workers < 1 or queue_depth < 0:
+            raise ValueError("A worker pool needs at least one worker and a queue depth of zero or more")
+        self.workers = workers
+        self.queue_depth = queue_depth
+        self.models = list(models or [])
+        self._slots = threading.BoundedSemaphore(workers + queue_depth)
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def _get_executor(self):
+        # the processes are created on the first request, after the http server has forked its own workers
+        with self._lock:
+            if self._executor is None:
+                threads = max(1, (os.cpu_count() or 1) // self.workers)
+                self._executor = ProcessPoolExecutor(
+                    self.workers, multiprocessing.get_context("spawn"), _init_worker, (self.models, threads))
+            return self._executor
+
+    def submit(self, function, *args, **kwargs):
+        """
+        Sends a function to the pool, or raises QueueFull at once if the pool is full
+        :param function: a picklable function
+        :param args: the picklable arguments of the function
+        :param kwargs: the picklable keyword arguments of the function
+        :return: a future with the result of the function
+        """
+        return self._submit(function, args, kwargs, False)
+
+    def submit_waiting(self, function, *args, **kwargs):
+        """
+        Sends a function to the pool, waiting for a free slot if the pool is full
+        :param function: a picklable function
+        :param args: the picklable arguments of the function
+        :param kwargs: the picklable keyword arguments of the function
+        :return: a future with the result of the function
+        """
+        return self._submit(function, args, kwargs, True)
+
+    def _submit(self, function, args: tuple, kwargs: dict, block: bool):
+        if not self._slots.acquire(blocking=block):
+            raise QueueFull("The pool has {} requests already".format(self.workers + self.queue_depth))
+        try:
+            running = self._get_executor().submit(function, *args, **kwargs)
+        except Exception:
+            self._slots.release()
+            raise
+        # the returned future is completed after the slot is released, so a client that got its result can always
+        # send a new request
+        future = Future()
+
+        def _finish(done: Future):
+            self._slots.release()
+            if done.exception() is not None:
+                future.set_exception(done.exception())
+            else:
+                future.set_result(done.result())
+
+        running.add_done_callback(_finish)
+        return future
+
+    def shutdown(self):
+        """Stops the worker processes, waiting for the running requests"""
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown()
+                self._executor = None
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def _environment_value(name: str, setting: str, default: int):
+    return int(os.environ.get("RETIPY_{}_{}".format(name.upper(), setting), default))
+
+
+def _new_pool(name: str, workers: int = None, queue_depth: int = None):
+    if name not in ENDPOINT_CLASSES:
+        raise ValueError("Unknown endpoint class '{}'".format(name))
+    if workers is None:
+        workers = _environment_value(name, "WORKERS", default_workers)
+    if queue_depth is None:
+        queue_depth = _environment_value(name, "QUEUE_DEPTH", default_queue_depth)
+    return WorkerPool(workers, queue_depth, ENDPOINT_MODELS[name])
+
+
+def configure(name: str, workers: int = None, queue_depth: int = None):
+    """
+    Replaces the pool of an endpoint class, the running requests of the previous pool are finished first
+    :param name: one of ENDPOINT_CLASSES
+    :param workers: number of worker processes, None takes it from the environment
+    :param queue_depth: number of waiting requests, None takes it from the environment
+    :return: the new pool
+    """
+    pool = _new_pool(name, workers, queue_depth)
+    with _pools_lock:
+        previous = _pools.get(name)
+        _pools[name] = pool
+    if previous is not None:
+        previous.shutdown()
+    return pool
+
+
+def get_pool(name: str):
+    """Returns the pool of an endpoint class, creating it from the environment the first time"""
+    with _pools_lock:
+        if name not in _pools:
+            _pools[name] = _new_pool(name)
+        return _pools[name]
+
+
+def run(name: str, function, *args):
+    """
+    Runs the work of an endpoint, in the pool of its class when the pools are enabled or in the calling thread
+    otherwise.
+    :param name: the endpoint class, one of ENDPOINT_CLASSES
+    :param function: a picklable function
+    :param args: the picklable arguments of the function
+    :return: the result of the function
+    """
+    if not enabled:
+        return function(*args)
+    return get_pool(name).submit(function, *args).result()
+
+
+def _run_inline(function, calls: list):
+    for index, (args, kwargs) in enumerate(calls):
+        try:
+            yield index, function(*args, **kwargs), None
+        except Exception as error:
+            yield index, None, error
+
+
+def _run_pool(pool: WorkerPool, function, calls, pending: dict):
+    def _send():
+        item = next(calls, None)
+        if item is not None:
+            index, (args, kwargs) = item
+            pending[pool.submit_waiting(function, *args, **kwargs)] = index
+
+    for _ in range(pool.workers - 1):
+        _send()
+    while pending:
+        done, _ = wait(list(pending), return_when=FIRST_COMPLETED)
+        for future in done:
+            index = pending.pop(future)
+            _send()
+            error = future.exception()
+            yield index, None if error is not None else future.result(), error
+
+
+def run_many(name: str, function, calls: list):
+    """
+    Runs several calls of a function, in the pool of its class when the pools are enabled or in the calling thread
+    otherwise. At most as many calls as workers in the pool are sent at the same time, so a batch does not take the
+    queue of the pool. The first call is rejected with QueueFull when the pool is full, the next ones wait for a slot.
+    :param name: the endpoint class, one of ENDPOINT_CLASSES
+    :param function: a picklable function
+    :param calls: a list with the (args, kwargs) of each call, all of them picklable
+    :return: an iterator of (index, result, error) tuples in the order in which the calls finish. The error is the
+             exception raised by the call, or None
+    """
+    if not enabled:
+        return _run_inline(function, calls)
+    pool = get_pool(name)
+    calls = iter(enumerate(calls))
+    pending = {}
+    item = next(calls, None)
+    if item is not None:
+        index, (args, kwargs) = item
+        pending[pool.submit(function, *args, **kwargs)] = index
+    return _run_pool(pool, function, calls, pending)
@@ -0,0 +1,116 @@
+# Retipy - Retinal Image Processing on Python
+# Copyright (C) 2018  Alejandro Valdes
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""tests for batch module"""
+
+import base64
+import io
+import json
+import sys
+import time
+from unittest import TestCase
+from retipyserver import app, cache, workers
+
+
+def _lines(response):
+    lines = [json.loads(line) for line in response.get_data().decode(sys.getdefaultencoding()).splitlines()]
+    return sorted(lines, key=lambda line: line["index"])
+
+
+class TestBatch(TestCase):
+    _resources = 'retipy/resources/images/'
+
+    def setUp(self):
+        self.app = app.test_client()
+        self.enabled = workers.enabled
+        cache.results.clear()
+        self.images = []
+        for name in ['img01.png', 'img02.png']:
+            with open(self._resources + name, 'rb') as image_file:
+                self.images.append(image_file.read())
+
+    def tearDown(self):
+        workers.enabled = self.enabled
+        for name in workers.ENDPOINT_CLASSES:
+            workers.get_pool(name).shutdown()
+
+    def _single(self, url: str, body: dict):
+        response = self.app.post(url, data=json.dumps(body), content_type="application/json")
+        return json.loads(response.get_data().decode(sys.getdefaultencoding()))
+
+    def test_json_batch(self):
+        items = [{"id": "first", "image": base64.b64encode(self.images[0]).decode()},
+                 {"image": base64.b64encode(self.images[1]).decode()},
+                 {"image": base64.b64encode(b"not an image").decode()},
+                 {"id": "missing"}]
+        response = self.app.post(
+            "/retipy/tortuosity/fractal/batch", data=json.dumps({"images": items}), content_type="application/json")
+        self.assertEqual("application/x-ndjson", response.mimetype)
+        lines = _lines(response)
+        self.assertEqual([0, 1, 2, 3], [line["index"] for line in lines])
+        self.assertEqual(["first", 1, 2, "missing"], [line["id"] for line in lines])
+        self.assertEqual([True, True, False, False], [line["success"] for line in lines])
+        for line, item in zip(lines[0:2], items[0:2]):
+            self.assertEqual(self._single("/retipy/tortuosity/fractal", item), line["result"])
+        self.assertIn("error", lines[2])
+        self.assertIn("KeyError", lines[3]["error"])
+
+    def test_multipart_batch(self):
+        with open(self._resources + 'original.tif', 'rb') as image_file:
+            image = image_file.read()
+        expected = self._single(
+            "/retipy/segmentation/double_segmentation", {"image": base64.b64encode(image).decode()})
+        response = self.app.post(
+            "/retipy/segmentation/double_segmentation/batch",
+            data={"image": [(io.BytesIO(image), "a.tif"), (io.BytesIO(image), "b.tif")]},
+            content_type="multipart/form-data")
+        lines = _lines(response)
+        self.assertEqual(["a.tif", "b.tif"], [line["id"] for line in lines])
+        for line in lines:
+            self.assertEqual(expected, line["result"])
+
+    def test_batch_no_success(self):
+        for body in [{"image": ""}, {"images": "x"}, [1]]:
+            response = self.app.post(
+                "/retipy/tortuosity/density/batch", data=json.dumps(body), content_type="application/json")
+            self.assertEqual({"success": False}, json.loads(response.get_data().decode(sys.getdefaultencoding())))
+        response = self.app.post(
+            "/retipy/vessel_classification/classification/batch",
+            data={"original_image": [(io.BytesIO(b"x"), "a.png")]}, content_type="multipart/form-data")
+        self.assertEqual({"success": False}, json.loads(response.get_data().decode(sys.getdefaultencoding())))
+
+    def test_pool_batch(self):
+        workers.enabled = True
+        workers.configure(workers.MEASURES, 1, 0)
+        items = [{"image": base64.b64encode(image).decode()} for image in self.images * 2 + [b"x"]]
+        lines = _lines(self.app.post(
+            "/retipy/tortuosity/fractal/batch", data=json.dumps({"images": items}), content_type="application/json"))
+        self.assertEqual([True, True, True, True, False], [line["success"] for line in lines])
+        self.assertEqual(lines[0]["result"], lines[2]["result"])
+
+        # the results are cached, the same batch does not use the pool
+        misses = cache.results.misses
+        lines = _lines(self.app.post(
+            "/retipy/tortuosity/fractal/batch", data=json.dumps({"images": items[0:2]}),
+            content_type="application/json"))
+        self.assertEqual([True, True], [line["success"] for line in lines])
+        self.assertEqual(misses, cache.results.misses)
+
+        running = workers.get_pool(workers.MEASURES).submit(time.sleep, 1)
+        response = self.app.post(
+            "/retipy/tortuosity/fractal/batch", data=json.dumps({"images": items[4:]}), content_type="application/json")
+        self.assertEqual(503, response.status_code)
+        running.result()
@@ -0,0 +1,155 @@
+# Retipy - Retinal Image Processing on Python
+# Copyright (C) 2018  Alejandro Valdes
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""tests for cache module"""
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+from unittest import TestCase
+from retipy import model_registry
+from retipyserver import app, cache
+
+
+class TestCache(TestCase):
+    _resources = 'retipy/resources/images/'
+    _image_path = _resources + 'img01.png'
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.app = app.test_client()
+        cache.results.clear()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_key(self):
+        key = cache.ResultCache.key("density", {"image": b"abc"}, {"fast": False})
+        self.assertEqual(key, cache.ResultCache.key("density", {"image": b"abc"}, {"fast": False}))
+        self.assertNotEqual(key, cache.ResultCache.key("fractal", {"image": b"abc"}, {"fast": False}))
+        self.assertNotEqual(key, cache.ResultCache.key("density", {"image": b"abd"}, {"fast": False}))
+        self.assertNotEqual(key, cache.ResultCache.key("density", {"image": b"abc"}, {"fast": True}))
+        self.assertNotEqual(key, cache.ResultCache.key("density", {"other": b"abc"}, {"fast": False}))
+
+    def test_key_version(self):
+        key = cache.ResultCache.key("density", {"image": b"abc"})
+        weights = os.path.join(self.directory, 'weights.h5')
+        with open(weights, 'w') as weights_file:
+            weights_file.write('weights')
+        model_registry.register('test_cache', weights, weights)
+        try:
+            registered = cache.ResultCache.key("density", {"image": b"abc"})
+            self.assertNotEqual(key, registered)
+            mtime = os.path.getmtime(weights)
+            os.utime(weights, (mtime + 10, mtime + 10))
+            self.assertNotEqual(registered, cache.ResultCache.key("density", {"image": b"abc"}))
+        finally:
+            del model_registry._models['test_cache']
+
+    def test_lru(self):
+        size = len(cache._encode({"value": "x" * 100}))
+        results = cache.ResultCache(2 * size)
+        results.put("a", {"value": "a" * 100})
+        results.put("b", {"value": "b" * 100})
+        self.assertEqual({"value": "a" * 100}, results.get("a"))
+        results.put("c", {"value": "c" * 100})
+        # b was the least recently used
+        self.assertIsNone(results.get("b"))
+        self.assertEqual({"value": "a" * 100}, results.get("a"))
+        self.assertEqual({"value": "c" * 100}, results.get("c"))
+        results.put("d", {"value": "d" * 1000})
+        self.assertIsNone(results.get("d"))
+        self.assertEqual(
+            {"hits": 3, "disk_hits": 0, "misses": 2, "entries": 2, "bytes": 2 * size, "max_bytes": 2 * size,
+             "directory": None, "max_directory_bytes": cache.default_max_directory_bytes},
+            results.stats())
+        self.assertRaises(ValueError, cache.ResultCache, -1)
+        self.assertRaises(ValueError, cache.ResultCache, 1, None, -1)
+
+    def test_encode(self):
+        result = {"segmentation": b"\x89PNG\x00", "values": [1, 2.5, "a"]}
+        data = cache._encode(result)
+        self.assertEqual(result, cache._decode(data))
+        self.assertEqual(["binary", "values"], sorted(json.loads(data.decode("utf-8")).keys()))
+
+    def test_directory(self):
+        results = cache.ResultCache(0, self.directory)
+        results.put("a", {"value": 1})
+        other = cache.ResultCache(1000, self.directory)
+        self.assertEqual({"value": 1}, other.get("a"))
+        self.assertEqual({"value": 1}, other.get("a"))
+        self.assertIsNone(other.get("b"))
+        self.assertEqual((2, 1, 1), (other.hits, other.disk_hits, other.misses))
+
+    def test_directory_budget(self):
+        size = len(cache._encode({"value": "x" * 100}))
+        results = cache.ResultCache(0, self.directory, 2 * size)
+        for index, name in enumerate(["aa", "ab", "ba"]):
+            results.put(name, {"value": name[0] * 100})
+            # the modification times order the files, they are set apart as the clock can be coarse
+            os.utime(results._path(name), (index, index))
+        self.assertIsNone(results.get("aa"))
+        # reading ab makes it the most recently used
+        self.assertEqual({"value": "a" * 100}, results.get("ab"))
+        results.put("bb", {"value": "b" * 100})
+        # ba was the least recently used
+        self.assertIsNone(results.get("ba"))
+        self.assertEqual({"value": "a" * 100}, results.get("ab"))
+        self.assertEqual({"value": "b" * 100}, results.get("bb"))
+        results.put("cc", {"value": "c" * 1000})
+        self.assertIsNone(results.get("cc"))
+
+    def test_directory_scans(self):
+        size = len(cache._encode({"value": "x" * 100}))
+        results = cache.ResultCache(0, self.directory, 3 * size)
+        scans = []
+        prune = results._prune
+        results._prune = lambda: scans.append(1) or prune()
+        results.put("aa", {"value": "a" * 100})
+        results.put("ab", {"value": "a" * 100})
+        results.put("ac", {"value": "a" * 100})
+        # only the first write scans the directory until the estimate goes over the budget
+        self.assertEqual(1, len(scans))
+        results.put("ad", {"value": "a" * 100})
+        self.assertEqual(2, len(scans))
+        self.assertEqual(3 * size, results._directory_bytes)
+
+    def test_cached(self):
+        calls = []
+
+        def _compute():
+            calls.append(1)
+            return {"value": 1}
+
+        results = cache.ResultCache(1000)
+        for _ in range(2):
+            self.assertEqual({"value": 1}, results.cached("e", {"image": b"a"}, {}, _compute))
+        self.assertEqual(1, len(calls))
+
+    def test_endpoint(self):
+        with open(self._image_path, 'rb') as image_file:
+            image = image_file.read()
+        first = self.app.post("/retipy/tortuosity/fractal", data=image, content_type="image/png").get_data()
+        start = time.perf_counter()
+        second = self.app.post("/retipy/tortuosity/fractal", data=image, content_type="image/png").get_data()
+        self.assertLess(time.perf_counter() - start, 0.1)
+        self.assertEqual(first, second)
+        stats = json.loads(self.app.get("/retipy/cache").get_data().decode(sys.getdefaultencoding()))
+        self.assertEqual(1, stats["hits"])
+        self.assertEqual(1, stats["misses"])
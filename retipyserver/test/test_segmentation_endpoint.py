@@ -16,8 +16,11 @@
 
 """tests for tortuosity endpoint module"""
 
+import base64
+import io
 import json
 import sys
+from PIL import Image
 from retipy.retina import Retina
 from retipyserver import app
 from unittest import TestCase
@@ -31,6 +34,51 @@ class TestSegmentationEndpoint(TestCase):
         self.image = Retina(None, self._image_path).original_base64
         self.app = app.test_client()
 
+    def _color_image(self):
+        with open(self._resources + 'original.tif', 'rb') as image_file:
+            return base64.b64encode(image_file.read()).decode()
+
     def double_segmentation_no_success(self):
         response = self.app.post("/retipy/segmentation/double_segmentation")
         self.assertEqual(json.loads(response.get_data().decode(sys.getdefaultencoding())), {'success': False})
+
+    def test_double_segmentation(self):
+        response = self.app.post(
+            "/retipy/segmentation/double_segmentation", data=json.dumps({"image": self._color_image()}),
+            content_type="application/json")
+        data = json.loads(response.get_data().decode(sys.getdefaultencoding()))
+        segmentation = Image.open(io.BytesIO(base64.b64decode(data["segmentation"])))
+        self.assertEqual((278, 234), segmentation.size)
+
+    def test_double_segmentation_binary(self):
+        with open(self._resources + 'original.tif', 'rb') as image_file:
+            image = image_file.read()
+        expected = json.loads(self.app.post(
+            "/retipy/segmentation/double_segmentation", data=json.dumps({"image": base64.b64encode(image).decode()}),
+            content_type="application/json").get_data().decode(sys.getdefaultencoding()))["segmentation"]
+
+        response = self.app.post(
+            "/retipy/segmentation/double_segmentation", data={"image": (io.BytesIO(image), "original.tif")},
+            content_type="multipart/form-data")
+        self.assertEqual("application/json", response.mimetype)
+        self.assertEqual(expected, json.loads(response.get_data().decode(sys.getdefaultencoding()))["segmentation"])
+
+        response = self.app.post(
+            "/retipy/segmentation/double_segmentation", data=image, content_type="image/tiff",
+            headers={"Accept": "image/png"})
+        self.assertEqual("image/png", response.mimetype)
+        self.assertEqual(base64.b64decode(expected), response.get_data())
+
+        response = self.app.post(
+            "/retipy/segmentation/double_segmentation?fast=true", data=image,
+            content_type="application/octet-stream", headers={"Accept": "image/png, application/json;q=0.5"})
+        self.assertEqual("image/png", response.mimetype)
+
+    def test_double_segmentation_binary_no_success(self):
+        response = self.app.post(
+            "/retipy/segmentation/double_segmentation", data={"other": (io.BytesIO(b"x"), "x.png")},
+            content_type="multipart/form-data")
+        self.assertEqual(json.loads(response.get_data().decode(sys.getdefaultencoding())), {'success': False})
+        response = self.app.post(
+            "/retipy/segmentation/double_segmentation", data=b"", content_type="image/png")
+        self.assertEqual(json.loads(response.get_data().decode(sys.getdefaultencoding())), {'success': False})
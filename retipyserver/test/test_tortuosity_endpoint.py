@@ -16,6 +16,7 @@
 
 """tests for tortuosity endpoint module"""
 
+import base64
 import json
 import sys
 from retipy.retina import Retina
@@ -39,3 +40,12 @@ class TestTortuosityEndpoint(TestCase):
     def test_fractal_no_success(self):
         response = self.app.post("/retipy/tortuosity/fractal")
         self.assertEqual(json.loads(response.get_data().decode(sys.getdefaultencoding())), {'success': False})
+
+    def test_fractal_binary(self):
+        with open(self._image_path, 'rb') as image_file:
+            image = image_file.read()
+        expected = self.app.post(
+            "/retipy/tortuosity/fractal", data=json.dumps({"image": base64.b64encode(image).decode()}),
+            content_type="application/json").get_data()
+        self.assertEqual(expected, self.app.post(
+            "/retipy/tortuosity/fractal", data=image, content_type="image/png").get_data())
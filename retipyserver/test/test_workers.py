@@ -0,0 +1,113 @@
+# Retipy - Retinal Image Processing on Python
+# Copyright (C) 2018  Alejandro Valdes
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""tests for workers module"""
+
+import base64
+import json
+import os
+import sys
+import time
+from unittest import TestCase
+from retipyserver import app, cache, workers
+
+
+class TestWorkers(TestCase):
+    _resources = 'retipy/resources/images/'
+    _image_path = _resources + 'img01.png'
+
+    def setUp(self):
+        self.app = app.test_client()
+        self.enabled = workers.enabled
+        # a cached result would be returned without going through the pools
+        cache.results.clear()
+
+    def tearDown(self):
+        workers.enabled = self.enabled
+        for name in workers.ENDPOINT_CLASSES:
+            workers.get_pool(name).shutdown()
+
+    def test_worker_pool(self):
+        pool = workers.WorkerPool(1, 1)
+        try:
+            self.assertEqual(8, pool.submit(pow, 2, 3).result())
+            running = pool.submit(time.sleep, 1)
+            waiting = pool.submit(pow, 2, 4)
+            self.assertRaises(workers.QueueFull, pool.submit, pow, 2, 5)
+            running.result()
+            self.assertEqual(16, waiting.result())
+            self.assertEqual(32, pool.submit(pow, 2, 5).result())
+            self.assertRaises(ValueError, pool.submit(int, "x").result)
+
+            running = pool.submit(time.sleep, 1)
+            waiting = pool.submit(pow, 2, 6)
+            # it waits until the sleep finishes and frees a slot
+            self.assertEqual(128, pool.submit_waiting(pow, 2, 7).result())
+            self.assertTrue(running.done())
+            self.assertEqual(64, waiting.result())
+        finally:
+            pool.shutdown()
+        self.assertRaises(ValueError, workers.WorkerPool, 0, 1)
+        self.assertRaises(ValueError, workers.WorkerPool, 1, -1)
+
+    def test_init_worker(self):
+        from retipy import tiles
+        threads = tiles.threads
+        try:
+            workers._init_worker([], 3)
+            if "RETIPY_THREADS" not in os.environ:
+                self.assertEqual(3, tiles.threads)
+        finally:
+            tiles.threads = threads
+        self.assertEqual(["modelVA"], workers.get_pool(workers.CLASSIFICATION).models)
+        self.assertEqual([], workers.get_pool(workers.SEGMENTATION).models)
+
+    def test_run(self):
+        workers.enabled = False
+        self.assertEqual(8, workers.run(workers.MEASURES, pow, 2, 3))
+        workers.enabled = True
+        self.assertEqual(8, workers.run(workers.MEASURES, pow, 2, 3))
+        self.assertRaises(ValueError, workers.get_pool, "unknown")
+
+    def test_run_many(self):
+        calls = [((2, 3), {}), (("x",), {}), ((2, 4), {})]
+        for enabled in [False, True]:
+            workers.enabled = enabled
+            results = sorted(workers.run_many(workers.MEASURES, pow, calls), key=lambda result: result[0])
+            self.assertEqual([(0, 8), (2, 16)], [(index, result) for index, result, _ in results[0::2]])
+            self.assertIsInstance(results[1][2], TypeError)
+            self.assertEqual([], list(workers.run_many(workers.MEASURES, pow, [])))
+
+    def test_busy_endpoint(self):
+        with open(self._image_path, 'rb') as image_file:
+            image = base64.b64encode(image_file.read()).decode()
+        workers.enabled = True
+        pool = workers.configure(workers.MEASURES, 1, 0)
+        running = pool.submit(time.sleep, 1)
+
+        response = self.app.post(
+            "/retipy/tortuosity/fractal", data=json.dumps({"image": image}), content_type="application/json")
+        self.assertEqual(503, response.status_code)
+        self.assertEqual("1", response.headers["Retry-After"])
+        self.assertFalse(json.loads(response.get_data().decode(sys.getdefaultencoding()))["success"])
+
+        # the other classes of endpoints are not affected
+        self.assertEqual(8, workers.run(workers.SEGMENTATION, pow, 2, 3))
+
+        running.result()
+        response = self.app.post(
+            "/retipy/tortuosity/fractal", data=json.dumps({"image": image}), content_type="application/json")
+        self.assertEqual(200, response.status_code)
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+
+# Retipy - Retinal Image Processing on Python
+# Copyright (C) 2018  Alejandro Valdes
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+script to compare the approximated median background estimation of retina_grayscale against the exact median filter.
+For each image and scale it prints the time of the median filter, the error of the background and, optionally, the
+agreement of the resulting double segmentation with the exact one.
+"""
+
+import argparse
+import glob
+import time
+
+import cv2
+import numpy as np
+from PIL import Image
+
+from retipy import evaluation, retina_grayscale
+
+parser = argparse.ArgumentParser()
+
+parser.add_argument(
+    "-i",
+    "--images",
+    help="glob with the images to process",
+    default="retipy/resources/images/img*.png")
+parser.add_argument(
+    "-s",
+    "--scales",
+    help="comma separated list of scales to compare",
+    default="2,4,8")
+parser.add_argument(
+    "--segmentation",
+    help="also compare the double segmentation obtained with each scale",
+    action="store_true")
+args = parser.parse_args()
+
+scales = [int(scale) for scale in args.scales.split(",")]
+
+
+def _segmentation(image: np.ndarray, scale: int):
+    # the uint8 mask is compared as it is, it is not encoded or decoded on the way
+    return retina_grayscale.Retina_grayscale(image, None, median_scale=scale).double_segmentation()
+
+
+def _background_input(retina: retina_grayscale.Retina_grayscale):
+    # the image given to the median filter in the first shadow correction
+    background = cv2.GaussianBlur(
+        cv2.blur(retina.np_image, (retina.kernel_mean_filter, retina.kernel_mean_filter)),
+        (retina.kernel_gaussian_filter, retina.kernel_gaussian_filter), 1.82)
+    background[retina.mask] = np.mean(background)
+    return background
+
+
+print("image, shape, kernel, scale, time (s), speedup, mean error, max error, segmentation dice")
+for filename in sorted(glob.glob(args.images)):
+    image = np.array(Image.open(filename).convert("RGB"))
+    retina = retina_grayscale.Retina_grayscale(image, filename)
+    background_input = _background_input(retina)
+
+    start = time.perf_counter()
+    exact = retina_grayscale.median_background(background_input, retina.kernel_median_filter)
+    exact_time = time.perf_counter() - start
+    exact_segmentation = _segmentation(image, 1) if args.segmentation else None
+    print("{}, {}, {}, 1, {:.4f}, 1.0, 0, 0, 1.0".format(
+        filename, retina.shape, retina.kernel_median_filter, exact_time))
+
+    for scale in scales:
+        start = time.perf_counter()
+        approximated = retina_grayscale.median_background(background_input, retina.kernel_median_filter, scale)
+        scale_time = time.perf_counter() - start
+        error = np.abs(approximated.astype(np.int16) - exact)
+        dice = float("nan")
+        if args.segmentation:
+            dice = evaluation.evaluate_segmentation(_segmentation(image, scale), exact_segmentation)["dice"]
+        print("{}, {}, {}, {}, {:.4f}, {:.1f}, {:.3f}, {}, {:.4f}".format(
+            filename, retina.shape, retina.kernel_median_filter, scale, scale_time, exact_time / scale_time,
+            error.mean(), error.max(), dice))